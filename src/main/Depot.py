@@ -2,11 +2,11 @@ import json
 from queue import Queue
 
 import pyperclip
-from collections import Counter
 from tkinter import *
 
 from utilImport import *
 from DepotParser import DepotParser
+from plannerModel import DepotModel
 from GlobalOverlays import OVERLAYS, GlobalSelection
 from ItemIndicator import ItemIndicator
 from widgets import CanvasLabel, LockableCanvas, ImageCheckbutton
@@ -24,16 +24,18 @@ class Depot(LockableCanvas):
             self.controlCanvasParent = parent
         super().__init__(parent, highlightthickness=0, bg=CONFIG.color, width=self.width, height=self.totalHeight)
 
-        self.updatesEnabled = True
+        # The model owns contents and requirements, the variables below only feed the labels. Edits are recalculated
+        # together once Tk is idle, scrolling an amount makes many of them
+        self.model = DepotModel(MATERIALS.values(), initialContents)
+        self.model.subscribe(self.updateMaterials)
+        self.pendingRecalculation = None
 
         self.scale = scale
         self.amountLabelHeight = self.scale // 5
         self.contents = {}
-        self.trueRequirements = {}
         self.craftingRequirements = {}
         self.missingMaterials = {}
         self.missingLabels = {}
-        self.craftable = []
         self.requirementLabels = {}
 
         self.indicators = {}
@@ -75,6 +77,7 @@ class Depot(LockableCanvas):
             self.researchButton = self.controlCanvas.create_image(0, self.scale // 4 * 9,
                                                                   image=UI_ELEMENTS["research-button"].getPhotoImage(self.scale // 2), anchor=W)
             self.controlCanvas.tag_bind(self.researchButton, "<Button-1>", lambda e: self.parseDepot())
+            self.controlCanvas.tag_bind(self.researchButton, "<Button-3>", lambda e: self.parseDepot(targeted=True))
 
         self.separator = self.contentCanvas.create_line(0, 0, 0, self.totalHeight, fill=CONFIG.highlightColor, width=1)
 
@@ -82,7 +85,7 @@ class Depot(LockableCanvas):
 
     def placeItemIndicator(self, material, x, y, initialAmount = 0):
         self.contents[material] = IntVar(value = initialAmount)
-        self.contents[material].trace("w", lambda *args: self.updateItemRequirementsInternal())
+        self.contents[material].trace("w", lambda *args: self.updateContentAmount(material))
 
         labelArgs = { "x": (x + 1) * self.scale - self.scale // 20,
                       "y": (y + 1) * self.scale - self.scale // 4 - self.scale // 20,
@@ -107,51 +110,37 @@ class Depot(LockableCanvas):
         self.missingLabels[material].raiseWidgets()
         self.indicators[material] = i
 
-    def updateItemRequirements(self, requirements):
-        self.trueRequirements = Counter(requirements)
-        self.updateItemRequirementsInternal()
-
-    def updateItemRequirementsInternal(self):
-        if not self.updatesEnabled:
-            return
+    def updateContentAmount(self, material):
+        if self.model.setAmount(material, self.contents[material].get()):
+            self.scheduleRecalculation()
 
-        requirements = self.trueRequirements.copy()
-
-        for tier in range(5, 0, -1):
-            for m in list(requirements.keys()):
-                if m.tier == tier and m.isCraftable():
-                    c = Counter(m.getIngredients())
-                    requirements += multiplyCounter(c, (max(0, requirements[m] - self.contents[m].get())))
-        for m in self.craftingRequirements.keys():
-            self.craftingRequirements[m].set(requirements[m])
-
-        missing = self.trueRequirements.copy()
-        craftPossible(missing, Counter(unpackVar(self.contents)))
-        for m in self.missingMaterials.keys():
-            self.missingMaterials[m].set(missing[m])
-
-        self.craftable = []
-        for i in range(5):
-            tier = i + 1
-            for m, a in self.craftingRequirements.items():
-                if m.tier == tier and m.isCraftable():
-                    craftable = True
-                    for ing in m.getIngredients().keys():
-                        if ing not in self.craftable and missing[ing] > 0:
-                            craftable = False
-                            break
-                    if craftable:
-                        self.craftable.append(m)
-                elif m.tier == tier and not m.isCraftable():
-                    if self.craftingRequirements[m].get() <= self.contents[m].get():
-                        self.craftable.append(m)
+    def updateItemRequirements(self, requirements):
+        self.model.setRequirements(requirements)
+        self.scheduleRecalculation()
 
-        self.draw()
+    def scheduleRecalculation(self):
+        if self.pendingRecalculation is None:
+            self.pendingRecalculation = self.after_idle(self.updateItemRequirementsInternal)
 
-    def draw(self):
-        for m in self.craftingRequirements.keys():
+    def updateItemRequirementsInternal(self):
+        if self.pendingRecalculation is not None:
+            self.after_cancel(self.pendingRecalculation)
+            self.pendingRecalculation = None
+        self.model.recalculate()
+
+    def updateMaterials(self, changed):
+        # Edited materials are redrawn along with every material whose requirement, missing amount or craftability changed
+        for m in changed:
+            self.craftingRequirements[m].set(self.model.getRequirement(m))
+            self.missingMaterials[m].set(self.model.getMissing(m))
+        self.draw(changed)
+
+    def draw(self, materials = None):
+        if materials is None:
+            materials = self.craftingRequirements.keys()
+        for m in materials:
             self.drawRequirementLabel(m, self.labelToggleButton.state)
-        self.renderIndicatorVisibility(self.indicatorToggleButton.state)
+        self.renderIndicatorVisibility(self.indicatorToggleButton.state, materials)
 
     def togglePage(self, state):
         if state:
@@ -162,58 +151,64 @@ class Depot(LockableCanvas):
         self.contentCanvas.config(scrollregion=(0, offset, self.width, offset + self.totalHeight))
 
     def drawRequirementLabel(self, material, showMissingAmount):
-        if self.craftingRequirements[material].get() > 0:
+        if self.model.getRequirement(material) > 0:
             self.missingLabels[material].setHidden(not showMissingAmount)
             self.requirementLabels[material].setHidden(showMissingAmount)
         else:
             self.missingLabels[material].hide()
             self.requirementLabels[material].hide()
 
-        if self.missingMaterials[material].get() > 0:
+        if self.model.getMissing(material) > 0:
             self.missingLabels[material].changeColor(color=CONFIG.depotColorInsufficient, fontColor=CONFIG.depotColorInsufficientFont)
         else:
             self.missingLabels[material].changeColor(color=CONFIG.depotColorSufficient, fontColor=CONFIG.depotColorSufficientFont)
 
-        if self.craftingRequirements[material].get() > self.contents[material].get() and (not material.isCraftable or not material in self.craftable):
+        if self.model.getRequirement(material) > self.model.getAmount(material) and (not material.isCraftable or not self.model.isCraftable(material)):
             self.requirementLabels[material].changeColor(color=CONFIG.depotColorInsufficient, fontColor=CONFIG.depotColorInsufficientFont)
         else:
             self.requirementLabels[material].changeColor(color=CONFIG.depotColorSufficient, fontColor=CONFIG.depotColorSufficientFont)
 
-    def renderIndicatorVisibility(self, state):
-        for m in self.indicators.keys():
-            if self.craftingRequirements[m].get() == 0 and state > 0:
+    def renderIndicatorVisibility(self, state, materials = None):
+        if materials is None:
+            materials = self.indicators.keys()
+        for m in materials:
+            if self.model.getRequirement(m) == 0 and state > 0:
                 self.indicators[m].hide()
                 self.missingLabels[m].hide()
                 self.requirementLabels[m].hide()
-            elif self.missingMaterials[m].get() == 0 and state > 1:
+            elif self.model.getMissing(m) == 0 and state > 1:
                 self.indicators[m].hide()
                 self.missingLabels[m].hide()
                 self.requirementLabels[m].hide()
             else:
                 self.indicators[m].show()
 
-    def parseDepot(self):
-        OVERLAYS["ParsedDepotContents"].registerCallback(self.updateDepot)
+    def parseDepot(self, targeted = False):
+        targetMaterials = None
+        if targeted:
+            # Ingredients count as well, what can be crafted depends on them
+            targetMaterials = [m for m in self.model.getMaterials() if self.model.getRequirement(m) > 0]
+        OVERLAYS["ParsedDepotContents"].registerCallback(self.updateDepot, targetMaterials)
 
     def updateDepot(self, materials):
-        self.updatesEnabled = False
+        # The model takes the amounts first, so the traces of the variables find nothing left to change
+        self.model.setAmounts(materials)
         for m, v in materials.items():
             self.contents[m].set(v)
-        self.updatesEnabled = True
         self.updateItemRequirementsInternal()
 
     def displayRecipe(self, material, x, y):
         OVERLAYS["RecipeDisplay"].displayRecipe(self, material, (x-1)*self.scale, ((y+1)*self.scale - 1) % self.pageHeight)
 
     def getContents(self):
-        return unpackVar(self.contents)
+        return self.model.getContents()
 
     def exportContentsForPenguinStats(self):
         result = {}
         items = []
         for m in MATERIALS.values():
             if m.internalId is not None:
-                items.append({ "id": m.internalId, "have": self.contents[m].get(), "need": self.trueRequirements[m] })
+                items.append({ "id": m.internalId, "have": self.model.getAmount(m), "need": self.model.trueRequirements[m] })
         result["items"] = items
         result["@type"] = "@penguin-statistics/planner/config"
 
@@ -255,8 +250,9 @@ class ParseDepotOverlay(GlobalSelection):
 
         self.indicators[material] = i
 
-    def registerCallback(self, callback):
+    def registerCallback(self, callback, targetMaterials = None):
         super().registerCallback(self.parent, 0, 0, callback, centered=True)
+        self.targetMaterials = targetMaterials
         self.changeStatus("Setting up...")
         self.parsing = True
         self.interrupted = False
@@ -267,8 +263,8 @@ class ParseDepotOverlay(GlobalSelection):
         self.update()
         self.after(0, self.startParsing)
 
-    def displayMaterial(self, material, amount):
-        self.workQueue.put(["Material", material, amount])
+    def displayMaterial(self, material, amount, confidence = 1):
+        self.workQueue.put(["Material", material, amount, confidence])
 
     def displayText(self, text, error = False):
         if self.error:
@@ -288,19 +284,20 @@ class ParseDepotOverlay(GlobalSelection):
         elif queueItem[0] == "Text":
             self.changeStatus(queueItem[1])
         elif queueItem[0] == "Material":
-            self.setMaterial(queueItem[1], queueItem[2])
+            self.setMaterial(queueItem[1], queueItem[2], queueItem[3])
 
         self.update()
         self.after(0, self.handleQueue)
 
     def startParsing(self):
-        self.parser = DepotParser(confidenceThreshold=CONFIG.imageRecognitionThreshold)
+        self.parser = DepotParser(confidenceThreshold=CONFIG.imageRecognitionThreshold, targetMaterials=self.targetMaterials)
         self.parser.startParsing(self.displayText, self.displayMaterial, self.notifyFinish)
         self.handleQueue()
 
-    def setMaterial(self, material, amount):
+    def setMaterial(self, material, amount, confidence = 1):
         i = self.indicators[material]
-        if amount is None:
+        # Unreadable and doubtful amounts are highlighted so they get checked before confirming
+        if amount is None or confidence < CONFIG.amountRecognitionConfidenceThreshold:
             self.vars[material].set(0)
             i.amountLabel.changeColor(color=CONFIG.depotColorInsufficient, fontColor=CONFIG.depotColorInsufficientFont)
 
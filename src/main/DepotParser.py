@@ -1,14 +1,21 @@
+import heapq
 import threading
 import time
-import shutil
 
+import numpy as np
 from PIL import Image
 
 from utilImport import *
-from database import DEPOT_ORDER
-from WindowHandler import resolveHandler
-from imageRecognizing import matchMasked
-from numberRecognizing import readImage, prepareImage
+from imageRecognizing import matchMasked, matchCoarseToFine, MATCH_LEVEL_COARSE, drawMatch, calculateSignature, signatureDistance
+from templateBank import getTemplate
+from materialIndex import MaterialIndex, alignMonotone
+from scanTimings import StageTimer
+from ocrWorkerPool import OcrWorkerPool
+from scanPipeline import ScanPipeline
+from numberRecognizing import readCrops, GlyphAtlas
+from downloadUtil import DYNAMIC_DATA_PATH
+from debugWriter import DebugWriter
+from amountCache import loadAmountCache, saveAmountCache, calculateCropKey
 
 SCREENSHOT_SIZE = (1641, 923)
 WINDOW_BORDER = CONFIG.arknightsWindowBorder
@@ -46,6 +53,13 @@ BOXES_ON_SCREEN = (7, 3)
 SCROLL_LINE_START = (1425 + CONFIG.depotScanScrollOffset, 360)
 SCROLL_LINE_END = (25, 360)
 
+# Scrolling has settled once consecutive downsampled captures differ by less than this on average
+SETTLE_POLL_INTERVAL = 0.05
+SETTLE_DOWNSAMPLING = 8
+SETTLE_DIFFERENCE_THRESHOLD = 1.0
+# A scroll moves the depot by several columns, so more pages than one per column means the end of the depot was missed
+EXTRA_SCAN_PAGES = 2
+
 DEPOT_END_CHECKS = [
     (1560, 160),
     (1560, 210),
@@ -54,8 +68,32 @@ DEPOT_END_CHECKS = [
     (1560, 330)
 ]
 
+SCREEN_DEPOT_FILTERED = "depot with filter"
+SCREEN_MAIN_MENU = "main menu"
+SCREEN_DEPOT = "depot"
+SCREEN_UNKNOWN = "unknown screen"
+
+# In order of precedence, the first screen whose checks all pass wins
+SCREEN_CHECKS = [
+    (SCREEN_DEPOT_FILTERED, DEPOT_FILTER_CHECKS),
+    (SCREEN_MAIN_MENU, MAIN_MENU_CHECKS),
+    (SCREEN_DEPOT, DEPOT_CHECKS)
+]
+
 AMOUNT_CROP_BOX = (116, 157, 181, 192)
 AMOUNT_CROP_BOX_SLIM = (123, 163, 176, 188)
+# Amount crops of every resolution are scaled to 4 times their size at SCREENSHOT_SIZE for the OCR
+AMOUNT_OCR_SIZE = ((AMOUNT_CROP_BOX[2] - AMOUNT_CROP_BOX[0]) * 4, (AMOUNT_CROP_BOX[3] - AMOUNT_CROP_BOX[1]) * 4)
+
+PIPELINE_QUEUE_SIZE = 2
+
+DEBUG_FOLDER = "debug/"
+
+GLYPH_ATLAS_FILE = DYNAMIC_DATA_PATH + "glyphAtlas.npz"
+
+# Box signatures closer than the first distance show the same box, ones further apart than the second different boxes
+SIGNATURE_MATCH_DISTANCE = 6
+SIGNATURE_DISTINCT_DISTANCE = 20
 
 def convertCoords(coords, handler):
     height = handler.findWindowDimensions(includeBorder=False)[3] - WINDOW_BORDER[1] - WINDOW_BORDER[3]
@@ -63,11 +101,6 @@ def convertCoords(coords, handler):
     factor = height / SCREENSHOT_SIZE[1]
     return int(coords[0] * factor), int(coords[1] * factor)
 
-def matchesColor(c1, c2, leniency = 3):
-    return (abs(c1[0] - c2[0]) <= leniency and
-            abs(c1[1] - c2[1]) <= leniency and
-            abs(c1[2] - c2[2]) <= leniency)
-
 def resizeArknights(windowHandler):
     windowHandler.resize((int(round(SCREENSHOT_SIZE[0] / CONFIG.displayScale)) + WINDOW_BORDER[0] + WINDOW_BORDER[2],
                           int(round(SCREENSHOT_SIZE[1] / CONFIG.displayScale)) + WINDOW_BORDER[1] + WINDOW_BORDER[3]))
@@ -77,217 +110,623 @@ def takeScreenshot(windowHandler):
     if CONFIG.resizeArknights:
         resizeArknights(windowHandler)
 
-    rawScreenshot = windowHandler.takeScreenshot()
-    screenshot = rawScreenshot.crop((
-        int(round(WINDOW_BORDER[0] * CONFIG.displayScale)),
-        int(round(WINDOW_BORDER[1] * CONFIG.displayScale)),
-        rawScreenshot.width - int(round(WINDOW_BORDER[2] * CONFIG.displayScale)),
-        rawScreenshot.height - int(round(WINDOW_BORDER[3] * CONFIG.displayScale))))
-    scaleFactor = SCREENSHOT_SIZE[1] / screenshot.height
-    screenshot = screenshot.resize((int(screenshot.width * scaleFactor), int(screenshot.height * scaleFactor)), Image.BICUBIC)
-    return screenshot.convert("RGB")
+    # The frame stays one array at its native resolution, the border is cropped as a view and copied exactly once.
+    # Everything measured on it is scaled through its ScreenGeometry instead of resizing the frame to SCREENSHOT_SIZE
+    rawScreenshot = windowHandler.takeScreenshotArray()
+    return np.ascontiguousarray(rawScreenshot[
+        int(round(WINDOW_BORDER[1] * CONFIG.displayScale)):rawScreenshot.shape[0] - int(round(WINDOW_BORDER[3] * CONFIG.displayScale)),
+        int(round(WINDOW_BORDER[0] * CONFIG.displayScale)):rawScreenshot.shape[1] - int(round(WINDOW_BORDER[2] * CONFIG.displayScale))])
+
+class ScreenGeometry:
+    # Positions and sizes of the depot layout for screenshots of one height, all constants are given for SCREENSHOT_SIZE
+    def __init__(self, height):
+        self.height = height
+        self.scale = height / SCREENSHOT_SIZE[1]
+
+        self.boxRadius = self.scaleLength(BOX_RADIUS)
+        self.amountCropBox = tuple(self.scaleLength(c) for c in AMOUNT_CROP_BOX)
+        self.searchRadius = max(1, self.scaleLength(CONFIG.imageRecognitionSearchRadius))
+        self.screenProbes = buildScreenProbes(self)
+
+    def scaleLength(self, length):
+        return int(round(length * self.scale))
+
+    def scalePoint(self, point):
+        return self.scaleLength(point[0]), self.scaleLength(point[1])
+
+    def boxCenter(self, firstBoxPosition, x, y):
+        return (self.scaleLength(firstBoxPosition[0] + x * MATERIAL_DISTANCE[0]),
+                self.scaleLength(firstBoxPosition[1] + y * MATERIAL_DISTANCE[1]))
+
+SCREEN_GEOMETRIES = {}
+
+def getScreenGeometry(height):
+    if height not in SCREEN_GEOMETRIES:
+        SCREEN_GEOMETRIES[height] = ScreenGeometry(height)
+    return SCREEN_GEOMETRIES[height]
 
 def scrollArknights(windowHandler, interruptCheckCallback):
     windowHandler.dragLine(convertCoords(SCROLL_LINE_START, windowHandler), convertCoords(SCROLL_LINE_END, windowHandler), CONFIG.depotScanScrollDelay,
                            interruptCheckCallback)
     # Give Arknights time to snap back in case of overscroll
-    time.sleep(0.5)
+    return waitForSettle(windowHandler, interruptCheckCallback)
+
+def waitForSettle(windowHandler, interruptCheckCallback):
+    start = time.perf_counter()
+    previousFrame = captureSettleFrame(windowHandler)
+    stableFrames = 0
+    while stableFrames < CONFIG.depotScanSettleFrames:
+        settleTime = time.perf_counter() - start
+        if settleTime > CONFIG.depotScanSettleTimeout:
+            LOGGER.debug("Scrolling did not settle within %.2fs", settleTime)
+            return settleTime
+        if interruptCheckCallback():
+            return settleTime
+
+        time.sleep(SETTLE_POLL_INTERVAL)
+        frame = captureSettleFrame(windowHandler)
+        if np.abs(frame - previousFrame).mean() < SETTLE_DIFFERENCE_THRESHOLD:
+            stableFrames += 1
+        else:
+            stableFrames = 0
+        previousFrame = frame
+
+    settleTime = time.perf_counter() - start
+    LOGGER.debug("Scrolling settled after %.2fs", settleTime)
+    return settleTime
+
+def captureSettleFrame(windowHandler):
+    # Only used to detect movement, so a sparse grayscale sample of the raw capture is enough
+    frame = windowHandler.takeScreenshotArray()[::SETTLE_DOWNSAMPLING, ::SETTLE_DOWNSAMPLING]
+    return frame.mean(axis=2)
 
 def clickArknights(windowHandler, coords, delay):
     windowHandler.click(convertCoords(coords, windowHandler), delay=delay)
 
-def checkEndOfDepot(image):
-    for p in DEPOT_END_CHECKS:
-        pix = image.getpixel(p)
-        if pix[0] < 200 or pix[1] < 200 or pix[2] < 200:
-            return False
-
-    return True
+class ScreenState:
+    def __init__(self, label, score, endOfDepot):
+        self.label = label
+        self.score = score
+        self.endOfDepot = endOfDepot
+
+def buildScreenProbes(geometry):
+    # All probe points of all screens in one table, so a screenshot is classified with a single lookup
+    coords, colors, leniencies, inverted, probeSets = [], [], [], [], []
+    for probeSet, (label, checks) in enumerate(SCREEN_CHECKS):
+        for point, color in checks:
+            coords.append(geometry.scalePoint(point))
+            probeSets.append(probeSet)
+            # Points without a color must not have the color of the first point of their set
+            inverted.append(color is None)
+            colors.append(color if color is not None else checks[0][1])
+            leniencies.append(CONFIG.colorLeniency if color is not None else min(3, 256 - CONFIG.colorLeniency))
+
+    # The end of the depot is reached once every end check is at least 200 bright in every band
+    for point in DEPOT_END_CHECKS:
+        coords.append(geometry.scalePoint(point))
+        probeSets.append(len(SCREEN_CHECKS))
+        inverted.append(False)
+        colors.append((255, 255, 255))
+        leniencies.append(55)
+
+    coords = np.array(coords)
+    return (coords[:, 1], coords[:, 0], np.array(colors, dtype=np.int16), np.array(leniencies)[:, np.newaxis],
+            np.array(inverted), np.array(probeSets))
+
+def classifyScreen(image):
+    probeY, probeX, colors, leniencies, inverted, probeSets = getScreenGeometry(image.shape[0]).screenProbes
+    pixels = image[probeY, probeX].astype(np.int16)
+    satisfied = np.all(np.abs(pixels - colors) <= leniencies, axis=1) != inverted
+    scores = np.bincount(probeSets, weights=satisfied) / np.bincount(probeSets)
+
+    endOfDepot = bool(scores[-1] == 1)
+    for (label, checks), score in zip(SCREEN_CHECKS, scores):
+        if score == 1:
+            return ScreenState(label, 1.0, endOfDepot)
+    return ScreenState(SCREEN_UNKNOWN, float(scores[:-1].max()), endOfDepot)
+
+def isSamePage(screenshot, previous):
+    a = screenshot[::SETTLE_DOWNSAMPLING, ::SETTLE_DOWNSAMPLING].astype(np.int16)
+    b = previous[::SETTLE_DOWNSAMPLING, ::SETTLE_DOWNSAMPLING].astype(np.int16)
+    return a.shape == b.shape and np.abs(a - b).mean() < SETTLE_DIFFERENCE_THRESHOLD
 
 def splitScreenshot(screenshot, firstBoxPosition):
+    geometry = getScreenGeometry(screenshot.shape[0])
+    radius = geometry.boxRadius
     boxes = []
     for x in range(BOXES_ON_SCREEN[0]):
         for y in range(BOXES_ON_SCREEN[1]):
-            posX = firstBoxPosition[0] + x * MATERIAL_DISTANCE[0]
-            posY = firstBoxPosition[1] + y * MATERIAL_DISTANCE[1]
-            boxes.append(screenshot.crop((posX - BOX_RADIUS, posY - BOX_RADIUS,
-                                          posX + BOX_RADIUS, posY + BOX_RADIUS)))
+            posX, posY = geometry.boxCenter(firstBoxPosition, x, y)
+            # Views into the screenshot, nothing gets copied until a box is actually drawn or saved
+            boxes.append(screenshot[posY - radius:posY + radius, posX - radius:posX + radius])
 
     return boxes
 
-def readAmount(box, fileName = None):
-    crop = box.crop(AMOUNT_CROP_BOX)
-    if CONFIG.debug:
-        safeSave(crop, "debug/numbers/{}.png".format(fileName))
-    ocrCrop = prepareImage(crop)
-    ocrResult = readImage(ocrCrop)
-    if CONFIG.debug:
-        safeSave(ocrCrop, "debug/numbers_processed/{}_{}.png".format(fileName, ocrResult))
-    return ocrResult
-
-def validateMenu(handler):
+def cropAmounts(boxes, geometry):
+    cropBox = geometry.amountCropBox
+    return [box[cropBox[1]:cropBox[3], cropBox[0]:cropBox[2]] for box in boxes]
+
+def saveAmountDebugImages(crops, ocrMasks, ocrResults, fileNames, save):
+    for crop, ocrMask, ocrResult, fileName in zip(crops, ocrMasks, ocrResults, fileNames):
+        save(crop, "numbers/{}.png".format(fileName))
+        save(ocrMask, "numbers_processed/{}_{}.png".format(fileName, ocrResult))
+
+def validateMenu(handler, debugWriter = None):
     image = takeScreenshot(handler)
-    if CONFIG.debug:
-        safeSave(image, "debug/menu.png")
+    if debugWriter is not None:
+        debugWriter.save(image, "menu.png", always=True)
 
-    filterPreselected = True
-    for p in DEPOT_FILTER_CHECKS:
-        if (p[1] is not None and not matchesColor(image.getpixel(p[0]), p[1], leniency=CONFIG.colorLeniency) or
-            p[1] is None and matchesColor(image.getpixel(p[0]), DEPOT_FILTER_CHECKS[0][1], leniency=min(3, 256 - CONFIG.colorLeniency))):
-            filterPreselected = False
-            break
+    state = classifyScreen(image)
+    LOGGER.debug("Scan: Screen looks like %s (score %.2f)", state.label, state.score)
 
-    if filterPreselected:
+    if state.label == SCREEN_DEPOT_FILTERED:
         clickArknights(handler, (DEPOT_CHECKS[0][0][0] - DEPOT_BUTTON_SIZE, DEPOT_CHECKS[0][0][1]), delay=0.5)
         clickArknights(handler, DEPOT_CHECKS[0][0], delay=0.5)
         LOGGER.debug("Scan: I'm in the depot with the Growth Material filter is preselected")
         return takeScreenshot(handler)
 
-    mainMenu = True
-    for p in MAIN_MENU_CHECKS:
-        if not matchesColor(image.getpixel(p[0]), p[1], leniency=CONFIG.colorLeniency):
-            mainMenu = False
-            break
-
-    if mainMenu:
+    if state.label == SCREEN_MAIN_MENU:
         clickArknights(handler, MAIN_MENU_DEPOT_BUTTON, delay=1)
         clickArknights(handler, DEPOT_CHECKS[0][0], delay=0.5)
         LOGGER.debug("Scan: I'm in the main menu")
         return takeScreenshot(handler)
 
-    inDepot = True
-    for p in DEPOT_CHECKS:
-        if (p[1] is not None and not matchesColor(image.getpixel(p[0]), p[1], leniency=CONFIG.colorLeniency) or
-            p[1] is None and matchesColor(image.getpixel(p[0]), DEPOT_CHECKS[0][1], min(3, 256 - CONFIG.colorLeniency))):
-            inDepot = False
-            break
-
-    if inDepot:
+    if state.label == SCREEN_DEPOT:
         clickArknights(handler, DEPOT_CHECKS[0][0], delay=0.5)
         LOGGER.debug("Scan: I'm in the depot")
         return takeScreenshot(handler)
 
     return None
 
+def loadGlyphAtlas():
+    try:
+        return GlyphAtlas.load(GLYPH_ATLAS_FILE)
+    except Exception as e:
+        LOGGER.warning("Could not read digit atlas, starting with an empty one: %s", e)
+        return GlyphAtlas()
+
+class ScannedPage:
+    def __init__(self, screenshot, finalPage):
+        self.screenshot = screenshot
+        self.finalPage = finalPage
+        self.geometry = None
+        self.boxes = None
+
 class DepotParser:
-    def __init__(self, image = None, confidenceThreshold = 0.95, debug = False):
-        if not image:
+    def __init__(self, image = None, confidenceThreshold = 0.95, debug = False, images = None, targetMaterials = None):
+        if image:
+            images = [image]
+
+        if not images:
+            # Only import the win32 dependent parts when actually scanning a window, replays also work without them
+            from WindowHandler import resolveHandler
             self.handler = resolveHandler(CONFIG.arknightsWindowName,
                                           childClass=CONFIG.arknightsInputWindowClass,
                                           advancedResolutionMode=CONFIG.usesBlueStacks() or CONFIG.usesLDPlayer())
-            self.image = None
+            self.images = None
         else:
             self.handler = None
-            self.image = image
+            self.images = list(images)
 
         self.debug = debug
         self.confidenceThreshold = confidenceThreshold
-        self.scrollThread = None
+        self.depotOrder = ENTITIES.getDepotOrder()
+        self.targetMaterials = None
+        if targetMaterials is not None:
+            # Materials that are never in the depot, like LMD, are left alone instead of being reported as missing
+            self.targetMaterials = { m for m in targetMaterials if ENTITIES.getDepotPosition(m) is not None }
+        if self.targetMaterials is None:
+            self.scanEnd = len(self.depotOrder)
+            self.expectedMaterials = list(self.depotOrder)
+        else:
+            # The depot order only tells roughly where the needed materials are, so a targeted scan still walks the
+            # depot from the start but ends once it found all of them or got past the last one
+            self.scanEnd = max((ENTITIES.getDepotPosition(m) for m in self.targetMaterials), default=-1) + 1
+            self.expectedMaterials = list(self.targetMaterials)
+        self.maxPages = -(-len(self.depotOrder) // BOXES_ON_SCREEN[1]) + EXTRA_SCAN_PAGES
         self.parseThread = None
-
+        self.ocrPool = None
+        self.pipeline = None
+        self.debugWriter = None
+
+        self.searches = 0
+        self.searchFallbacks = 0
+        self.coarseDecisions = 0
+        self.fineDecisions = 0
+        self.indexSearches = 0
+        self.indexFallbacks = 0
+        self.alignedBoxes = 0
+        self.alignmentMisses = 0
+        self.overlapSearches = 0
+        self.overlapFallbacks = 0
+        self.glyphAtlas = loadGlyphAtlas()
+        self.glyphSamples = []
+        self.amountCache = loadAmountCache()
+        self.timer = StageTimer(tracing=CONFIG.depotScanTraceFile is not None)
 
     def startParsing(self, statusCallback, materialCallback, finishCallback):
-        if self.image is None and not self.handler.ready:
+        if self.handler is not None and not self.handler.ready:
             statusCallback("Arknights is not running or cannot be found. Check your Arknights Window configuration.", error = True)
             finishCallback(False)
             return
 
+        statusCallback = self.traceCallback("statusCallback", statusCallback)
+        materialCallback = self.traceCallback("materialCallback", materialCallback)
+        finishCallback = self.traceCallback("finishCallback", finishCallback)
+
         self.materialIndex = 0
-        self.finalPage = False
+        self.boxNumber = 0
+        self.foundMaterials = set()
+        self.alignmentScores = {}
+        self.pageCount = 0
+        # A targeted scan without any depot materials to look for has nothing to do
+        self.classificationDone = len(self.expectedMaterials) == 0
         self.interrupted = False
+        self.statusCallback = statusCallback
+        if self.classificationDone:
+            LOGGER.info("Scan: None of the needed materials are kept in the depot, nothing to scan")
+            finishCallback(True)
+            return
 
         if CONFIG.debug:
-            shutil.rmtree("debug", ignore_errors=True)
+            self.debugWriter = DebugWriter(DEBUG_FOLDER, CONFIG.debugQueueSize, sampleRate=CONFIG.debugSampleRate,
+                                           imageFormat=CONFIG.debugImageFormat)
+
+        with self.timer.measure("index"):
+            self.signatureIndex = MaterialIndex.build(MATERIALS.values())
 
         if self.handler is not None:
-            screenshot = validateMenu(self.handler)
+            with self.timer.measure("menu"):
+                screenshot = validateMenu(self.handler, self.debugWriter)
         else:
-            screenshot = Image.open(self.image).convert("RGB")
+            screenshot = self.nextScreenshot()
 
         if screenshot is None:
+            self.closeDebugWriter()
             statusCallback("Can not scan depot from here, please navigate to the main menu or the depot.", error = True)
             finishCallback(False)
             return
 
-        self.loadNextPage(screenshot, firstPage=True)
-        self.parseThread = threading.Thread(target=lambda : self.parse(statusCallback, materialCallback, finishCallback))
-        self.parseThread.start()
+        self.ocrPool = OcrWorkerPool(CONFIG.depotScanOcrWorkers, CONFIG.depotScanOcrQueueSize,
+                                     useProcesses=CONFIG.depotScanOcrProcesses)
+
+        # Each stage runs in its own thread, so the next page is captured and classified while amounts are still being read
+        self.pipeline = ScanPipeline(PIPELINE_QUEUE_SIZE, errorCallback=self.handleError)
+        self.pipeline.addSource("capture", lambda emit: self.capturePages(screenshot, emit))
+        self.pipeline.addStage("split", self.splitPage)
+        self.pipeline.addStage("classify", self.classifyPage, stallCallback=self.notifyClassificationStall)
+        self.pipeline.addStage("ocr", self.readPageAmounts, finish=lambda emit: self.ocrPool.shutdown())
+        self.pipeline.addStage("emit", lambda amounts, emit: self.emitAmounts(amounts, materialCallback))
 
+        self.parseThread = threading.Thread(target=lambda : self.parse(statusCallback, finishCallback), name="Scan")
+        self.parseThread.start()
 
-    def loadNextPage(self, screenshot, firstPage = False):
-        if checkEndOfDepot(screenshot):
-            self.finalPage = True
-            self.boxes = splitScreenshot(screenshot, FIRST_MATERIAL_CENTER_END)
-            if not firstPage:
-                self.boxIndex = self.findFirstUnknownBox()
+    def parse(self, statusCallback, finishCallback):
+        statusCallback("Scanning...")
+        self.pipeline.run()
+
+        LOGGER.debug("Scan: %s material comparisons were decided on the coarse level, %s needed the full resolution",
+                     self.coarseDecisions, self.fineDecisions)
+        LOGGER.debug("Scan: %s of %s material searches fell back to the full box", self.searchFallbacks, self.searches)
+        LOGGER.debug("Scan: %s of %s aligned boxes did not hold the material the alignment gave them", self.alignmentMisses, self.alignedBoxes)
+        LOGGER.debug("Scan: %s of %s boxes were not among their index candidates", self.indexFallbacks, self.indexSearches)
+        weakest = heapq.nsmallest(5, ((score, m) for m, (score, confidence) in self.alignmentScores.items()
+                                      if score is not None), key=lambda s: s[0])
+        LOGGER.debug("Scan: Weakest alignment scores: %s", ", ".join("{} {:.3f}".format(m, score) for score, m in weakest))
+        LOGGER.debug("Scan: %s of %s page overlap searches fell back to template matching", self.overlapFallbacks, self.overlapSearches)
+        LOGGER.debug("Scan timings:\n%s", self.timer.report())
+        LOGGER.debug("Scan pipeline:\n%s", self.pipeline.report())
+        self.updateGlyphAtlas()
+        LOGGER.debug("Scan: %s of %s amounts were taken from the cache", self.amountCache.hits,
+                     self.amountCache.hits + self.amountCache.misses)
+        saveAmountCache(self.amountCache)
+        self.closeDebugWriter()
+        self.writeTrace()
+        finishCallback(self.classificationDone and not self.interrupted)
+
+    def nextScreenshot(self):
+        with self.timer.measure("capture"):
+            if self.handler is not None:
+                return takeScreenshot(self.handler)
+            # Replays simply continue with the next screenshot instead of scrolling
+            return np.asarray(Image.open(self.images.pop(0)).convert("RGB"))
+
+    def capturePages(self, screenshot, emit):
+        pageNumber = 1
+        previous = None
+        while True:
+            if previous is not None and isSamePage(previous, screenshot):
+                # Scrolling did not move the depot, without an end check there is no telling what comes after it
+                LOGGER.warning("Scan: Page %s is the same as the one before, stopping the scan", pageNumber)
+                return
+            if pageNumber > self.maxPages:
+                LOGGER.warning("Scan: Stopping after %s pages without reaching the end of the depot", self.maxPages)
+                return
+
+            # The same lookup that decides the end of the depot also notices when the scan left it
+            state = classifyScreen(screenshot)
+            if state.label == SCREEN_MAIN_MENU:
+                raise RuntimeError("Left the depot while scanning")
+            if state.label == SCREEN_UNKNOWN:
+                LOGGER.debug("Scan: Unexpected screen on page %s (best score %.2f)", pageNumber, state.score)
+
+            finalPage = state.endOfDepot
+            emit(ScannedPage(screenshot, finalPage))
+            if finalPage or self.classificationDone or self.interrupted:
+                return
+
+            if self.handler is not None:
+                with self.timer.measure("scroll"):
+                    settleTime = scrollArknights(self.handler, lambda : self.interrupted or self.classificationDone)
+                self.timer.add("settle", settleTime)
+            elif len(self.images) == 0:
+                return
+
+            if self.classificationDone or self.interrupted:
+                return
+            previous, screenshot = screenshot, self.nextScreenshot()
+            pageNumber += 1
+
+    def splitPage(self, page, emit):
+        page.geometry = getScreenGeometry(page.screenshot.shape[0])
+        with self.timer.measure("split"):
+            if page.finalPage:
+                page.boxes = splitScreenshot(page.screenshot, FIRST_MATERIAL_CENTER_END)
             else:
-                self.boxIndex = 0
+                page.boxes = splitScreenshot(page.screenshot, FIRST_MATERIAL_CENTER)
+        emit(page)
+
+    def classifyPage(self, page, emit):
+        if self.classificationDone:
+            # Pages captured before the classification was done hold nothing the scan still needs
+            return
+
+        self.boxes = page.boxes
+        self.geometry = page.geometry
+        if self.pageCount > 0:
+            # The final page snaps back and a short scroll repeats columns, both show boxes of the previous top row again
+            self.boxIndex = self.findFirstUnknownBox()
+            if self.boxIndex > 0 and not page.finalPage:
+                LOGGER.debug("Scan: Skipping %s boxes that were already on the previous page", self.boxIndex)
         else:
-            self.boxes = splitScreenshot(screenshot, FIRST_MATERIAL_CENTER)
             self.boxIndex = 0
-            self.scrollThread = threading.Thread(target=lambda : scrollArknights(self.handler, lambda : self.interrupted))
-            self.scrollThread.start()
-        self.lastTopRow = [None for i in range(BOXES_ON_SCREEN[0])]
+        self.lastTopRow = [(None, None) for i in range(BOXES_ON_SCREEN[0])]
+        self.pageCount += 1
+
+        self.pageAmounts = []
+        alignment = self.alignBoxes()
+        while not self.classificationDone and not self.interrupted and self.boxIndex < len(self.boxes):
+            self.parseMaterialAmount(alignment[self.boxIndex])
+            self.boxIndex += 1
+
+        missingMaterials = []
+        if page.finalPage and not self.interrupted:
+            self.classificationDone = True
+        if self.classificationDone:
+            # Only now it is certain that everything not found so far is not in the depot
+            missingMaterials = [m for m in self.expectedMaterials if m not in self.foundMaterials]
+        emit((self.pageAmounts, missingMaterials, self.geometry))
+
+    def notifyClassificationStall(self, stalled):
+        # The first page is always there right away, after that the classification can only wait for scrolling
+        if self.handler is not None and self.pageCount > 0:
+            self.statusCallback("Waiting for scroll to finish..." if stalled else "Scanning...")
 
     def findFirstUnknownBox(self):
+        self.overlapSearches += 1
+        signature = calculateSignature(self.boxes[0])
+        distances = [signatureDistance(signature, s) if s is not None else np.inf for m, s in self.lastTopRow]
+
+        order = np.argsort(distances)
+        closest, secondClosest = distances[order[0]], distances[order[1]]
+        if closest < SIGNATURE_MATCH_DISTANCE and secondClosest > SIGNATURE_DISTINCT_DISTANCE:
+            return (BOXES_ON_SCREEN[0] - order[0]) * BOXES_ON_SCREEN[1]
+        if closest > SIGNATURE_DISTINCT_DISTANCE:
+            return 0
+
+        # Signatures can not tell the candidates apart, so compare against the actual materials
+        self.overlapFallbacks += 1
         c = 0
-        for m in self.lastTopRow:
-            if matchMasked(self.boxes[0], m)[1] > self.confidenceThreshold:
+        for m, s in self.lastTopRow:
+            if m is not None and self.matchBox(self.boxes[0], m)[1] > self.confidenceThreshold:
                 return (BOXES_ON_SCREEN[0] - c) * BOXES_ON_SCREEN[1]
             c += 1
         return 0
 
-    def parse(self, statusCallback, materialCallback, finishCallback):
-        threads = []
-        statusCallback("Scanning...")
-        while self.materialIndex < len(DEPOT_ORDER) and not self.interrupted:
-            if self.boxIndex >= len(self.boxes):
-                if self.handler is not None and not self.finalPage:
-                    if self.scrollThread.is_alive():
-                        statusCallback("Waiting for scroll to finish...")
-                    self.scrollThread.join()
-                    statusCallback("Scanning...")
-                    self.loadNextPage(takeScreenshot(self.handler))
-
-            thread = self.parseMaterialAmount(materialCallback, statusCallback)
-            if thread is not None:
-                threads.append(thread)
-            self.materialIndex += 1
-
-        for t in threads:
-            t.join()
-
-        finishCallback(self.materialIndex >= len(DEPOT_ORDER))
-
-    def parseMaterialAmount(self, materialCallback, statusCallback):
-        material = MATERIALS[DEPOT_ORDER[self.materialIndex]]
+    def alignBoxes(self):
+        # Scores all new boxes of the page against all materials still expected in the depot order in one batch, so a
+        # single bad score can not shift the materials of the boxes after it
+        alignment = [None] * len(self.boxes)
+        boxes = self.boxes[self.boxIndex:]
+        remaining = [m for m in self.depotOrder[self.materialIndex:] if m not in self.foundMaterials]
+        if self.classificationDone or len(boxes) == 0 or len(remaining) == 0:
+            return alignment
+
+        with self.timer.measure("align"):
+            distances = self.signatureIndex.calculateDistances(boxes, self.geometry.scale)
+            # Scores are measured against how far a box is from materials in general, which takes the place of a threshold
+            scores = np.median(distances, axis=1, keepdims=True) - distances[:, self.signatureIndex.getColumns(remaining)]
+            for i, j in enumerate(alignMonotone(scores)):
+                if j is not None:
+                    alignment[self.boxIndex + i] = (remaining[j], scores[i, j])
+        return alignment
+
+    def parseMaterialAmount(self, aligned):
         box = self.boxes[self.boxIndex]
+        material, location, confidence = self.identifyBox(box, aligned)
+        self.boxNumber += 1
+        if self.debugWriter is not None:
+            size = getTemplate(material, self.geometry.scale).image.shape[1::-1] if material is not None else (0, 0)
+            self.debugWriter.save(lambda : drawMatch(box, location, size),
+                                  "boxes/{}_{:.3}.png".format(self.boxNumber, confidence))
+        if material is None:
+            LOGGER.debug("Scan: Could not identify box %s on page %s (best confidence %.3f)", self.boxIndex, self.pageCount, confidence)
+            return
 
-        result, confidence = matchMasked(box, material)
-        if CONFIG.debug:
-            safeSave(result, "debug/boxes/{}_{:.3}.png".format(self.materialIndex, confidence))
-        if confidence > self.confidenceThreshold:
-            if self.boxIndex % BOXES_ON_SCREEN[1] == 0:
-                self.lastTopRow[self.boxIndex // BOXES_ON_SCREEN[1]] = material
-            self.boxIndex += 1
-            return self.readAmountAsync(box, self.materialIndex, material, materialCallback, statusCallback)
+        if self.boxIndex % BOXES_ON_SCREEN[1] == 0:
+            self.lastTopRow[self.boxIndex // BOXES_ON_SCREEN[1]] = (material, calculateSignature(box))
+        if material in self.foundMaterials:
+            LOGGER.debug("Scan: Found %s a second time", material)
+            return
+        self.foundMaterials.add(material)
+        self.alignmentScores[material] = (aligned[1] if aligned is not None and aligned[0] is material else None, confidence)
+
+        position = ENTITIES.getDepotPosition(material)
+        if position is None:
+            LOGGER.debug("Scan: %s is not part of the known depot order", material)
+        elif position < self.materialIndex:
+            LOGGER.debug("Scan: %s comes earlier in the depot than the known depot order says", material)
         else:
-            materialCallback(material, self.convertAmount(None))
-            return None
+            self.materialIndex = position + 1
+
+        if self.targetMaterials is None or material in self.targetMaterials:
+            self.pageAmounts.append((box, self.boxNumber, material))
+        # Nothing the scan looks for can come after the last expected material of the depot order
+        if self.materialIndex >= self.scanEnd or self.foundMaterials.issuperset(self.expectedMaterials):
+            self.classificationDone = True
+
+    def identifyBox(self, box, aligned = None):
+        best = (None, (0, 0), 0)
+        tried = []
+        if aligned is not None:
+            self.alignedBoxes += 1
+            location, confidence = self.matchBox(box, aligned[0])
+            if confidence > self.confidenceThreshold:
+                return aligned[0], location, confidence
+            self.alignmentMisses += 1
+            best = (None, location, confidence)
+            tried.append(aligned[0])
+
+        # Candidates the index finds closest, tried in depot order so the known order still decides between look-alikes
+        self.indexSearches += 1
+        with self.timer.measure("index"):
+            candidates = self.signatureIndex.query(box, self.geometry.scale, CONFIG.depotScanIndexCandidates)
+        candidates.sort(key=lambda m: (ENTITIES.getDepotPosition(m, len(self.depotOrder)) < self.materialIndex,
+                                       ENTITIES.getDepotPosition(m, len(self.depotOrder))))
+        candidates = [m for m in candidates if m not in tried]
+
+        for m in candidates:
+            location, confidence = self.matchBox(box, m)
+            if confidence > self.confidenceThreshold:
+                return m, location, confidence
+            best = max(best, (None, location, confidence), key=lambda b: b[2])
+
+        # Icons the index could not place are checked against the next materials of the depot order as well
+        self.indexFallbacks += 1
+        for m in self.depotOrder[self.materialIndex:self.materialIndex + CONFIG.depotScanIndexCandidates]:
+            if m in candidates or m in tried:
+                continue
+            location, confidence = self.matchBox(box, m)
+            if confidence > self.confidenceThreshold:
+                return m, location, confidence
+            best = max(best, (None, location, confidence), key=lambda b: b[2])
+
+        return best
+
+    def matchBox(self, box, material):
+        with self.timer.measure("match"):
+            template = getTemplate(material, self.geometry.scale)
+            location, confidence, level = matchCoarseToFine(box, template, self.confidenceThreshold,
+                                                            CONFIG.imageRecognitionCoarseMargin,
+                                                            searchRadius=self.geometry.searchRadius)
+            if level == MATCH_LEVEL_COARSE:
+                self.coarseDecisions += 1
+                return location, confidence
+            self.fineDecisions += 1
+
+            # Confidences close to the threshold might be due to the material being off-center, so search the full box
+            self.searches += 1
+            if abs(confidence - self.confidenceThreshold) < CONFIG.imageRecognitionFallbackMargin:
+                self.searchFallbacks += 1
+                location, confidence = matchMasked(box, template)
+
+        return location, confidence
+
+    def readPageAmounts(self, pageResult, emit):
+        pageAmounts, missingMaterials, geometry = pageResult
+        if len(missingMaterials) > 0:
+            emit([(m, None, 1.0) for m in missingMaterials])
+        if len(pageAmounts) == 0:
+            return
+
+        boxes, materialIndices, materials = zip(*pageAmounts)
+        crops = cropAmounts(boxes, geometry)
+
+        # Slots whose pixels did not change since an earlier scan are not read again
+        cachedAmounts = []
+        uncached = []
+        for crop, materialIndex, material in zip(crops, materialIndices, materials):
+            key = calculateCropKey(crop)
+            amount = self.amountCache.get(key)
+            if amount is not None:
+                cachedAmounts.append((material, amount, 1.0))
+            else:
+                uncached.append((crop, materialIndex, material, key))
+        if len(cachedAmounts) > 0:
+            emit(cachedAmounts)
+        if len(uncached) == 0:
+            return
+        crops, materialIndices, materials, keys = zip(*uncached)
 
-    def readAmountAsync(self, box, materialIndex, material, materialCallback, statusCallback):
-        def readAndNotifyAmount():
+        def notifyAmounts(future):
             try:
-                amount = readAmount(box, fileName=materialIndex)
-                materialCallback(material, self.convertAmount(amount))
+                readings, (duration, start, worker) = future.result()
+                self.timer.add("ocr", duration, start, worker)
+                if self.debugWriter is not None:
+                    saveAmountDebugImages(crops, readings.masks, readings.amounts, materialIndices, self.debugWriter.save)
+                self.glyphSamples.extend(readings.glyphSamples)
+                for key, amount, confidence in zip(keys, readings.amounts, readings.confidences):
+                    if confidence >= 1 and amount != "":
+                        self.amountCache.put(key, amount)
+                emit(list(zip(materials, readings.amounts, readings.confidences)))
             except Exception as e:
-                self.interrupted = True
-                statusCallback("Error encountered during scanning of depot: " + str(e), error = True)
-                LOGGER.exception("Scanning Error: ")
+                self.handleError(e)
 
-        thread = threading.Thread(target=readAndNotifyAmount)
-        thread.start()
-        return thread
+        # Blocks while the OCR workers are busy, which keeps the scan from running away from them
+        self.ocrPool.submit(notifyAmounts, readCrops, crops, self.debugWriter is not None, self.glyphAtlas, AMOUNT_OCR_SIZE)
+
+    def emitAmounts(self, amounts, materialCallback):
+        for material, amount, confidence in amounts:
+            if confidence < CONFIG.amountRecognitionConfidenceThreshold:
+                LOGGER.debug("Scan: Unsure about the amount of %s. Read '%s' with confidence %.2f", material, amount, confidence)
+            materialCallback(material, self.convertAmount(amount), confidence)
+
+    def updateGlyphAtlas(self):
+        # The atlas learns from every amount the digit rules could read, so later scans can fill in what they miss
+        added = self.glyphAtlas.add(self.glyphSamples)
+        if added > 0:
+            try:
+                createDirsIfNeeded(GLYPH_ATLAS_FILE)
+                self.glyphAtlas.save(GLYPH_ATLAS_FILE)
+                LOGGER.debug("Scan: Added %s glyphs to the digit atlas", added)
+            except Exception as e:
+                LOGGER.warning("Could not save digit atlas: %s", e)
+
+    def traceCallback(self, name, callback):
+        def tracedCallback(*args, **kwargs):
+            with self.timer.measure(name):
+                return callback(*args, **kwargs)
+        return tracedCallback
+
+    def writeTrace(self):
+        if CONFIG.depotScanTraceFile is None:
+            return
+        try:
+            createDirsIfNeeded(CONFIG.depotScanTraceFile)
+            self.timer.writeTrace(CONFIG.depotScanTraceFile)
+            LOGGER.info("Scan trace written to %s", CONFIG.depotScanTraceFile)
+        except Exception as e:
+            LOGGER.warning("Could not write scan trace: %s", e)
+
+    def closeDebugWriter(self):
+        if self.debugWriter is not None:
+            self.debugWriter.close()
+            self.debugWriter = None
+
+    def handleError(self, error):
+        self.stop()
+        self.statusCallback("Error encountered during scanning of depot: " + str(error), error = True)
+        LOGGER.exception("Scanning Error: ")
 
     def convertAmount(self, amount):
         if amount is None:
@@ -303,12 +742,14 @@ class DepotParser:
 
     def stop(self):
         self.interrupted = True
+        if self.pipeline is not None:
+            self.pipeline.stop()
+        if self.ocrPool is not None:
+            self.ocrPool.cancel()
 
     def destroy(self):
         # Make sure all threads finish gracefully before destroying the handler
         if self.parseThread is not None:
             self.parseThread.join()
-        if self.scrollThread is not None:
-            self.scrollThread.join()
         if self.handler is not None:
-            self.handler.cleanup()
\ No newline at end of file
+            self.handler.cleanup()
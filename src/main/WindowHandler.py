@@ -5,6 +5,7 @@ import win32api
 import win32con
 import win32gui
 import win32ui
+import numpy as np
 from PIL import Image
 
 from utilImport import LOGGER, CONFIG
@@ -152,6 +153,14 @@ class WindowHandler:
 
         return im
 
+    def takeScreenshotArray(self):
+        # RGB view straight onto the captured BGRX bits, cropping or copying is left to the caller
+        self.printWindowToBuffer()
+        bmpinfo = self.bitmapBuffer.GetInfo()
+        bmpstr = self.bitmapBuffer.GetBitmapBits(True)
+
+        return np.frombuffer(bmpstr, dtype=np.uint8).reshape(bmpinfo['bmHeight'], bmpinfo['bmWidth'], 4)[:, :, 2::-1]
+
     def printWindowToBuffer(self):
         borderFlag = 1
         if self.captureBorder:
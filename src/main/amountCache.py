@@ -0,0 +1,87 @@
+import hashlib
+import json
+import os.path
+from collections import OrderedDict
+from threading import Lock
+
+from utilImport import *
+from downloadUtil import DYNAMIC_DATA_PATH
+from numberRecognizing import OCR_VERSION
+
+AMOUNT_CACHE_FILE = DYNAMIC_DATA_PATH + "amountCache.json"
+
+def calculateCropKey(crop):
+    # The raw pixels decide the amount, so identical crops can reuse an earlier reading
+    return hashlib.blake2b(crop.tobytes(), digest_size=16).hexdigest()
+
+class AmountCache:
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.lock = Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.changed = False
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def put(self, key, amount):
+        if self.capacity <= 0:
+            return
+
+        with self.lock:
+            self.entries[key] = amount
+            self.entries.move_to_end(key)
+            # Least recently used entries are first
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+            self.changed = True
+
+    def save(self, fileName):
+        with self.lock:
+            data = { "version": OCR_VERSION, "entries": list(self.entries.items()) }
+            self.changed = False
+
+        f = safeOpen(fileName, "w+")
+        json.dump(data, f)
+        f.close()
+
+    @staticmethod
+    def load(fileName, capacity):
+        cache = AmountCache(capacity)
+        if not os.path.isfile(fileName):
+            return cache
+
+        with open(fileName, "r") as f:
+            data = json.load(f)
+        # Entries read by an older OCR might be wrong, so they are all dropped
+        if data.get("version") != OCR_VERSION:
+            LOGGER.debug("Discarding amount cache of OCR version %s", data.get("version"))
+            return cache
+
+        for key, amount in data["entries"][-capacity:] if capacity > 0 else []:
+            cache.entries[key] = amount
+        return cache
+
+def loadAmountCache():
+    try:
+        return AmountCache.load(AMOUNT_CACHE_FILE, CONFIG.amountCacheSize)
+    except Exception as e:
+        LOGGER.warning("Could not read amount cache, starting with an empty one: %s", e)
+        return AmountCache(CONFIG.amountCacheSize)
+
+def saveAmountCache(cache):
+    if not cache.changed:
+        return
+    try:
+        cache.save(AMOUNT_CACHE_FILE)
+    except Exception as e:
+        LOGGER.warning("Could not save amount cache: %s", e)
@@ -0,0 +1,149 @@
+import random
+import sys
+import time
+from collections import Counter
+
+from util import multiplyCounter
+from requirementEngine import RequirementEngine
+
+class SyntheticMaterial:
+    def __init__(self, name, tier, ingredients = None):
+        self.name = name
+        self.canonicalName = name
+        self.tier = tier
+        self.ingredients = ingredients
+
+    def isCraftable(self):
+        return self.ingredients is not None
+
+    def getIngredients(self):
+        if self.isCraftable():
+            return dict(self.ingredients)
+
+    def __repr__(self):
+        return self.name
+
+def buildRecipeGraph(rng, materialsPerTier = 12):
+    # Every tier above the first is crafted from a few materials of the tiers directly below it, like the game's recipes
+    tiers = { 1: [SyntheticMaterial("T1-" + str(i), 1) for i in range(materialsPerTier)] }
+    for tier in range(2, 6):
+        tiers[tier] = []
+        for i in range(materialsPerTier):
+            lower = tiers[tier - 1] + (tiers[tier - 2] if tier > 2 else [])
+            ingredients = { m: rng.randint(1, 4) for m in rng.sample(lower, rng.randint(1, 3)) }
+            tiers[tier].append(SyntheticMaterial("T{}-{}".format(tier, i), tier, ingredients))
+    # LMD is never crafted and is the only material the solver does not use up
+    return [SyntheticMaterial("LMD", 4)] + [m for materials in tiers.values() for m in materials]
+
+def buildPlan(rng, materials, units):
+    # Mostly top tier materials, the ones plans need hundreds of
+    plan = Counter()
+    highTiers = [m for m in materials if m.tier >= 4]
+    for i in range(units):
+        plan[rng.choice(highTiers if rng.random() < 0.8 else materials)] += 1
+    # Plans come from sets of upgrades, the order of their materials is arbitrary
+    items = list(plan.items())
+    rng.shuffle(items)
+    plan = Counter(dict(items))
+    depot = Counter({ m: rng.randint(0, 40) * (6 - m.tier) ** 2 for m in materials })
+    return plan, depot
+
+def calculateByUnit(materials, plan, depot):
+    # The former implementation with Counters, which finds one crafting path per missing unit
+    requirements = Counter(plan)
+    for tier in range(5, 0, -1):
+        for m in list(requirements.keys()):
+            if m.tier == tier and m.isCraftable():
+                requirements += multiplyCounter(Counter(m.getIngredients()), max(0, requirements[m] - depot[m]))
+
+    missing, available = Counter(plan), Counter(depot)
+    craftPossibleByUnit(missing, available)
+
+    craftable = []
+    for tier in range(1, 6):
+        for m in materials:
+            if m.tier == tier and m.isCraftable():
+                if all(ing in craftable or missing[ing] <= 0 for ing in m.getIngredients().keys()):
+                    craftable.append(m)
+            elif m.tier == tier and not m.isCraftable():
+                if requirements[m] <= depot[m]:
+                    craftable.append(m)
+    return requirements, missing, craftable
+
+def craftPossibleByUnit(missing, available):
+    # Unchanged from the former util.craftPossible. Materials of a tier compete for the depot in the order of the keys
+    # of missing
+    for tier in range(5, 0, -1):
+        for m in list(missing.keys()):
+            if m.tier != tier:
+                continue
+            if m.canonicalName == "LMD":
+                missing[m] -= min(missing[m], available[m])
+                continue
+
+            while missing[m] > 0:
+                path = findUnitCraftingPath(m, available)
+                if path is None:
+                    break
+                else:
+                    missing[m] -= 1
+                    available -= path
+
+            if m.isCraftable():
+                missing += Counter(multiplyCounter(m.getIngredients(), missing[m]))
+
+def findUnitCraftingPath(material, available):
+    if available[material] > 0:
+        return Counter({ material: 1 })
+    if not material.isCraftable():
+        return None
+
+    path = Counter(material.getIngredients())
+    while True:
+        if path <= available:
+            return path
+        else:
+            for m in list(path.keys()):
+                if available[m] >= path[m]:
+                    continue
+                if not m.isCraftable():
+                    return None
+
+                need = max(0, path[m] - available[m])
+                path += multiplyCounter(Counter(m.getIngredients()), need)
+                path[m] -= need
+
+def runBenchmark(plans = 20, units = (10, 100, 1000, 5000), seed = 0, repeats = 20):
+    # The engine against the former implementation, the way the depot recalculates on every edit
+    rng = random.Random(seed)
+    materials = buildRecipeGraph(rng)
+    engine = RequirementEngine(materials)
+    print("{:>6} {:>12} {:>12} {:>8}".format("Units", "ByUnit(ms)", "Engine(ms)", "Speedup"))
+    identical = True
+    for u in units:
+        unitTime = engineTime = 0
+        for i in range(plans):
+            plan, depot = buildPlan(rng, materials, u)
+            start = time.perf_counter()
+            expected = calculateByUnit(materials, plan, depot)
+            unitTime += time.perf_counter() - start
+
+            contents = engine.toArray(depot)
+            start = time.perf_counter()
+            for r in range(repeats):
+                result = engine.calculate(plan, contents)
+            engineTime += (time.perf_counter() - start) / repeats
+
+            if (engine.toArray(expected[0]) != result[0]).any() or (engine.toArray(+expected[1]) != result[1]).any() \
+                    or expected[2] != result[2]:
+                identical = False
+                print("Results differ for plan", dict(plan))
+        print("{:>6} {:>12.3f} {:>12.3f} {:>7.1f}x".format(u, unitTime / plans * 1000, engineTime / plans * 1000,
+                                                          unitTime / max(engineTime, 1e-9)))
+    print("Both gave identical results" if identical else "The engine and the former implementation disagree")
+    return identical
+
+if __name__ == "__main__":
+    # Usage: craftingBenchmark.py [plans per size]
+    plans = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    sys.exit(0 if runBenchmark(plans=plans) else 1)
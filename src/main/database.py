@@ -153,7 +153,7 @@ class Material(ScalableImage):
 
     def renderImage(self, **flags):
         if self.renderedImage is None:
-            border = loadImage("img/border/T" + str(self.tier) + ".png")
+            border = loadImage(getBorderPath(self.tier))
             border.alpha_composite(self.image, ((border.width - self.image.width) // 2, (border.height - self.image.height) // 2))
             self.renderedImage = border
         return self.renderedImage.copy()
@@ -247,6 +247,8 @@ def loadMaterials(progressCallback):
             future.result()
 
     DEPOT_ORDER += rawMaterials["depotOrder"]
+    # Operator costs and recipes look materials up by their internal id, which is only fast with the indexes in place
+    ENTITIES.buildIndexes(DEPOT_ORDER)
 
     return rawMaterials["pageSize"]
 
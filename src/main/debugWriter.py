@@ -0,0 +1,84 @@
+import os.path
+import queue
+import shutil
+import threading
+import time
+
+import numpy as np
+from PIL import Image
+
+from utilImport import *
+
+class DebugWriter:
+    def __init__(self, folder, queueSize, sampleRate = 1, imageFormat = "png"):
+        self.folder = folder
+        self.queue = queue.Queue(maxsize=queueSize)
+        self.sampleRate = sampleRate
+        self.imageFormat = imageFormat.lower()
+
+        self.lock = threading.Lock()
+        self.sampleCredit = 0
+        self.written = 0
+        self.skipped = 0
+        self.dropped = 0
+        self.bytesWritten = 0
+        self.writeTime = 0
+
+        self.thread = threading.Thread(target=self.run, name="DebugWriter")
+        self.thread.start()
+
+    def save(self, image, fileName, always = False):
+        # Scan threads save concurrently
+        with self.lock:
+            if not always:
+                # Deterministic sampling, a rate of 0.25 keeps every fourth artifact
+                self.sampleCredit += self.sampleRate
+                if self.sampleCredit < 1:
+                    self.skipped += 1
+                    return
+                self.sampleCredit -= 1
+
+            try:
+                self.queue.put_nowait((image, fileName))
+            except queue.Full:
+                # Never let the scan wait for the disk, losing some artifacts is better than changing its timing
+                self.dropped += 1
+
+    def run(self):
+        # Clearing the previous artifacts happens here as well, so starting a scan does not wait for it
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+
+            start = time.perf_counter()
+            try:
+                self.write(*item)
+            except Exception as e:
+                LOGGER.warning("Could not write debug image %s: %s", item[1], e)
+            self.writeTime += time.perf_counter() - start
+
+    def write(self, image, fileName):
+        # Images can also be handed over as a function, so drawing them happens here instead of in the scan
+        if callable(image):
+            image = image()
+        if isinstance(image, np.ndarray):
+            image = Image.fromarray(image)
+
+        fileName = os.path.join(self.folder, os.path.splitext(fileName)[0] + "." + self.imageFormat)
+        createDirsIfNeeded(fileName)
+        if self.imageFormat == "png":
+            image.save(fileName, compress_level=1)
+        else:
+            image.save(fileName)
+
+        self.written += 1
+        self.bytesWritten += os.path.getsize(fileName)
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        LOGGER.debug("Debug images: %s written (%.1f KB in %.2fs), %s skipped by sampling, %s dropped",
+                     self.written, self.bytesWritten / 1024, self.writeTime, self.skipped, self.dropped)
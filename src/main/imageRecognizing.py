@@ -2,27 +2,105 @@ import cv2
 import numpy as np
 from PIL import Image, ImageDraw
 
-def matchMasked(targetRGB, material):
-    templateImage = material.renderImage().convert("RGB")
-    mask = createMask(material, templateImage.size)
+# Factor the grayscale level of the coarse to fine matching is downsampled by
+COARSE_FACTOR = 4
+MATCH_LEVEL_COARSE = "coarse"
+MATCH_LEVEL_FINE = "fine"
 
-    return findMatch(targetRGB, templateImage, mask=mask)
+def matchMasked(targetRGB, template, searchRadius = None):
+    return findMatch(targetRGB, template.image, mask=template.mask, searchRadius=searchRadius)
 
-def findMatch(image, template, mask=None):
-    w, h = template.size
-    redCircle = image.copy()
+def matchCoarseToFine(targetRGB, template, threshold, margin, searchRadius = None):
+    # Clear matches and clear misses are already decided on the small grayscale level, only scores close to the
+    # threshold need the full resolution RGB match
+    loc, conf = findCoarseMatch(cv2.cvtColor(targetRGB, cv2.COLOR_RGB2GRAY), template.getCoarse(), searchRadius)
+    if abs(conf - threshold) >= margin:
+        return loc, conf, MATCH_LEVEL_COARSE
 
-    res = cv2.matchTemplate(np.array(image), np.array(template), cv2.TM_CCOEFF_NORMED, mask=mask)
+    loc, conf = matchMasked(targetRGB, template, searchRadius=searchRadius)
+    return loc, conf, MATCH_LEVEL_FINE
+
+def findCoarseMatch(gray, coarseTemplate, searchRadius = None, factor = COARSE_FACTOR):
+    # Downsampling the target once would only line its cells up with the template's at every factor-th offset, so the
+    # cell means are taken at every offset instead and the template is compared to every factor-th of them. Scores
+    # the same as TM_CCOEFF_NORMED with a mask at every offset of the full resolution search
+    h, w = coarseTemplate.image.shape[:2]
+    width, height = w * factor, h * factor
+    startX, endX, startY, endY = 0, gray.shape[1] - width, 0, gray.shape[0] - height
+    if searchRadius is not None:
+        centerX, centerY = endX // 2, endY // 2
+        startX, endX = max(0, centerX - searchRadius), min(endX, centerX + searchRadius)
+        startY, endY = max(0, centerY - searchRadius), min(endY, centerY + searchRadius)
+
+    mask = coarseTemplate.mask.ravel()
+    templateImage = coarseTemplate.image.ravel().astype(np.float32)
+    maskedTemplate = mask * (templateImage - (mask @ templateImage) / mask.sum())
+    # Sums of the windows weighted by the mask, by the masked template and by the squared mask
+    weights = np.stack((mask / mask.sum(), maskedTemplate * mask, mask ** 2), axis=1)
+
+    cells = cv2.blur(gray.astype(np.float32), (factor, factor), anchor=(0, 0))[startY:, startX:]
+    rowStride, columnStride = cells.strides
+    columns = endX - startX + 1
+    sums = np.empty((endY - startY + 1, columns, 3), dtype=np.float32)
+    squaredSums = np.empty((endY - startY + 1, columns), dtype=np.float32)
+    # One row of offsets at a time, all windows at once would take megabytes for every comparison
+    for y in range(endY - startY + 1):
+        windows = np.lib.stride_tricks.as_strided(cells[y:], shape=(columns, h, w),
+                                                  strides=(columnStride, factor * rowStride, factor * columnStride))
+        windows = windows.reshape(columns, h * w)
+        sums[y] = windows @ weights
+        squaredSums[y] = (windows * windows) @ weights[:, 2]
+
+    means, correlation, maskSums = sums[..., 0], sums[..., 1], sums[..., 2]
+    correlation = correlation - means * weights[:, 1].sum()
+    variance = squaredSums - 2 * means * maskSums + means ** 2 * weights[:, 2].sum()
+    scores = correlation / np.sqrt(np.maximum(variance * (maskedTemplate ** 2).sum(), 1e-12))
+    # Flat areas have no variance to compare against, like the infinities findMatch filters
+    scores[variance <= 1e-6] = 0
+
+    y, x = np.unravel_index(np.argmax(scores), scores.shape)
+    return (startX + int(x), startY + int(y)), float(scores[y, x])
+
+def downsampleGray(image, factor = COARSE_FACTOR):
+    return downsample(cv2.cvtColor(image, cv2.COLOR_RGB2GRAY), factor)
+
+def downsample(image, factor = COARSE_FACTOR):
+    # Cut to whole cells, so every coarse pixel is the mean of exactly factor by factor pixels
+    height, width = image.shape[0] // factor, image.shape[1] // factor
+    return cv2.resize(image[:height * factor, :width * factor], (width, height), interpolation=cv2.INTER_AREA)
+
+def findMatch(image, template, mask=None, searchRadius=None):
+    h, w = template.shape[:2]
+
+    target = image
+    offset = (0, 0)
+    if searchRadius is not None:
+        # Only search the offsets around the template being centered in the image
+        centerX = (target.shape[1] - w) // 2
+        centerY = (target.shape[0] - h) // 2
+        offset = (max(0, centerX - searchRadius), max(0, centerY - searchRadius))
+        target = target[offset[1]:centerY + searchRadius + h, offset[0]:centerX + searchRadius + w]
+
+    res = cv2.matchTemplate(target, template, cv2.TM_CCOEFF_NORMED, mask=mask)
     # CCOEFF_NORMED sometimes outputs infinity instead of 0 filter those occurrences
     res[res == np.inf] = 0
     min_val, max_val, min_loc, max_loc = cv2.minMaxLoc(res)
 
-    loc = max_loc
-    mask = Image.fromarray(np.uint8(mask), mode="L")
+    return (max_loc[0] + offset[0], max_loc[1] + offset[1]), max_val
+
+def drawMatch(image, loc, size):
+    redCircle = Image.fromarray(image)
     draw = ImageDraw.Draw(redCircle)
-    draw.rectangle((loc, (loc[0] + w, loc[1] + h)), outline = (255,), width = 2)
+    draw.rectangle((loc, (loc[0] + size[0], loc[1] + size[1])), outline = (255,), width = 2)
+
+    return redCircle
+
+def calculateSignature(image, size = 8):
+    # Tiny colour thumbnail, identical boxes stay close even when shifted by a few pixels
+    return cv2.resize(image, (size, size), interpolation=cv2.INTER_AREA).astype(np.int16)
 
-    return redCircle, max_val
+def signatureDistance(signature1, signature2):
+    return np.abs(signature1 - signature2).mean()
 
 def createMask(material, size):
     mask = centerTransparentImage(material.image, size)
@@ -0,0 +1,92 @@
+import cv2
+import numpy as np
+
+from templateBank import getTemplate
+
+# Resolution boxes and templates are compared at, small enough that shifts of a few pixels do not matter
+INDEX_IMAGE_SIZE = (32, 32)
+INDEX_THUMBNAIL_SIZE = 6
+INDEX_HISTOGRAM_BINS = 4
+
+def calculateFeatures(image, weights):
+    image = cv2.resize(image, INDEX_IMAGE_SIZE, interpolation=cv2.INTER_AREA)
+
+    # Colours of the icon area only, averaged per cell so the background around the icon has no say
+    weighted = cv2.resize(image.astype(np.float32) * weights[..., None], (INDEX_THUMBNAIL_SIZE, INDEX_THUMBNAIL_SIZE),
+                          interpolation=cv2.INTER_AREA)
+    cellWeights = cv2.resize(weights, (INDEX_THUMBNAIL_SIZE, INDEX_THUMBNAIL_SIZE), interpolation=cv2.INTER_AREA)
+    thumbnail = (weighted / np.maximum(cellWeights, 1e-6)[..., None]).ravel() / 255
+
+    bins = (image // (256 // INDEX_HISTOGRAM_BINS)).astype(np.int32)
+    colourIndex = (bins[..., 0] * INDEX_HISTOGRAM_BINS + bins[..., 1]) * INDEX_HISTOGRAM_BINS + bins[..., 2]
+    histogram = np.bincount(colourIndex.ravel(), weights=weights.ravel(), minlength=INDEX_HISTOGRAM_BINS ** 3)
+    # Square roots make euclidean distances behave like the Hellinger distance between the histograms
+    histogram = np.sqrt(histogram / max(histogram.sum(), 1e-6))
+
+    return np.concatenate((thumbnail / np.sqrt(len(thumbnail)), histogram)).astype(np.float32)
+
+class MaterialIndex:
+    def __init__(self, materials, features, weights, templateSize):
+        self.materials = materials
+        self.features = features
+        self.weights = weights
+        self.templateSize = templateSize
+        self.columns = { m: i for i, m in enumerate(materials) }
+
+    def query(self, box, scale = 1, k = 5):
+        distances = self.calculateDistances([box], scale)[0]
+        k = min(k, len(self.materials))
+        candidates = np.argpartition(distances, k - 1)[:k]
+        return [self.materials[i] for i in candidates[np.argsort(distances[candidates])]]
+
+    def calculateDistances(self, boxes, scale = 1):
+        # Compare the part of each box a centered template would cover
+        width, height = (int(round(s * scale)) for s in self.templateSize)
+        features = []
+        for box in boxes:
+            top = max(0, (box.shape[0] - height) // 2)
+            left = max(0, (box.shape[1] - width) // 2)
+            features.append(calculateFeatures(box[top:top + height, left:left + width], self.weights))
+
+        # All boxes against all materials at once, one row per box
+        features = np.stack(features)
+        squared = (features ** 2).sum(axis=1)[:, None] + (self.features ** 2).sum(axis=1)[None, :] - 2 * features @ self.features.T
+        return np.sqrt(np.maximum(squared, 0))
+
+    def getColumns(self, materials):
+        return [self.columns[m] for m in materials]
+
+    @staticmethod
+    def build(materials):
+        materials = list(materials)
+        templates = [getTemplate(m) for m in materials]
+        templateSize = templates[0].image.shape[1::-1]
+
+        # Every material is described with the same weights, as the material in a box is not known beforehand
+        masks = [cv2.resize(t.mask, INDEX_IMAGE_SIZE, interpolation=cv2.INTER_AREA) for t in templates]
+        weights = np.mean([m > 0 for m in masks], axis=0).astype(np.float32)
+
+        features = np.stack([calculateFeatures(t.image, weights) for t in templates])
+        return MaterialIndex(materials, features, weights, templateSize)
+
+def alignMonotone(scores):
+    # Assigns rows to columns in increasing order with the highest total score, rows may stay unassigned at no cost
+    # and columns may be skipped. Returns the column of every row or None
+    rows, columns = scores.shape
+    best = np.zeros((rows + 1, columns + 1))
+    for i in range(rows):
+        matched = np.concatenate(([-np.inf], best[i, :-1] + scores[i]))
+        best[i + 1] = np.maximum.accumulate(np.maximum(best[i], matched))
+
+    assignment = [None] * rows
+    i, j = rows, columns
+    while i > 0 and j > 0:
+        if best[i, j] == best[i, j - 1]:
+            j -= 1
+        elif best[i, j] == best[i - 1, j]:
+            i -= 1
+        else:
+            assignment[i - 1] = j - 1
+            i -= 1
+            j -= 1
+    return assignment
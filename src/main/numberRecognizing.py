@@ -1,8 +1,28 @@
+import os.path
+
+import cv2
+import numpy as np
 from PIL import Image
 
 SCANLINE_HIGH = 58
 SCANLINE_LOW = 91
 
+SATURATION_THRESHOLD = 10
+VALUE_THRESHOLD = 210
+
+# Bump this whenever changes to the amount recognition can read the same crop differently, so cached amounts get discarded
+OCR_VERSION = 2
+
+# Every glyph is scaled to this many columns and rows before being compared against the atlas
+GLYPH_FEATURE_SIZE = (8, 12)
+# Bump this whenever the glyph features change, so stored atlases get discarded
+GLYPH_ATLAS_VERSION = 1
+GLYPH_ATLAS_SAMPLES_PER_DIGIT = 20
+# Glyphs further away than this from every atlas entry are not trusted at all
+GLYPH_MAX_DISTANCE = 3.0
+# Unreadable specks smaller than this are noise rather than digits and do not lower the confidence
+GLYPH_MIN_PIXELS = 40
+
 def readImage(imageL):
     number = ""
     lastBlack = imageL.width
@@ -50,6 +70,9 @@ def readNumber(imageL):
         if not p and white:
             white = False
 
+    return classifyDigit(high, low, vertical)
+
+def classifyDigit(high, low, vertical):
     if len(high) == 1 and len(low) == 1 and len(vertical) == 1:
         return '1'
     elif len(high) == 1 and len(low) == 1 and len(vertical) == 3 and high[0] - low[0] > 10:
@@ -106,7 +129,7 @@ def prepareImage(image):
     image = detectOverlay(image)
 
     # Filter anything that is either too colorful or too dark to be white font
-    filterNoise(image, saturationThreshold=10, valueThreshold=210)
+    filterNoise(image, saturationThreshold=SATURATION_THRESHOLD, valueThreshold=VALUE_THRESHOLD)
 
     # Convert to grayscale
     image = image.convert("L")
@@ -114,5 +137,193 @@ def prepareImage(image):
     return image
 
 
+def prepareArray(image):
+    masks, overlayStarts = prepareArrays([image])
+    return masks[0][:, overlayStarts[0]:]
+
+def readArray(mask):
+    return readArrays(mask[np.newaxis], [0])[0]
+
+def prepareArrays(images, size = None):
+    # Same steps as prepareImage, but on a whole stack of equally sized crops instead of single pixels.
+    # Crops of other resolutions can be scaled to a fixed size instead of 4 times their own
+    images = [Image.fromarray(i) if isinstance(i, np.ndarray) else i for i in images]
+    scaled = np.stack([np.asarray(i.resize(size or (int(i.width*4), int(i.height*4)), Image.BICUBIC)) for i in images])
+    count, height, width = scaled.shape[:3]
+    hsv = np.asarray(Image.fromarray(scaled.reshape(count * height, width, 3)).convert("HSV")).reshape(scaled.shape)
+
+    # The dark overlay starts at the first column where every pixel is darker than in the column before
+    value = hsv[:, :, :, 2]
+    overlayColumns = np.all(value[:, :, :-1] > value[:, :, 1:], axis=1)
+    overlayStarts = np.where(overlayColumns.any(axis=1), np.argmax(overlayColumns, axis=1) + 1, 0)
+
+    masks = (hsv[:, :, :, 1] <= SATURATION_THRESHOLD) & (hsv[:, :, :, 2] >= VALUE_THRESHOLD)
+    return masks, overlayStarts
+
+def readArrays(masks, overlayStarts, atlas = None):
+    return classifyGlyphs(findGlyphs(masks, overlayStarts), len(masks), atlas)[0]
+
+def findGlyphs(masks, overlayStarts):
+    width = masks.shape[2]
+
+    blankColumns = ~masks.any(axis=1)
+    high = findRunStarts(masks[:, SCANLINE_HIGH])
+    low = findRunStarts(masks[:, SCANLINE_LOW])
+
+    # One entry of amount index, digit according to the rules and feature vector per glyph, in reading order
+    glyphs = []
+    for i, overlayStart in enumerate(overlayStarts):
+        # Like readImage, everything left of the overlay and its first column never separate two digits
+        separators = np.flatnonzero(blankColumns[i, overlayStart + 1:]) + overlayStart + 1
+        bounds = np.append(separators, width)
+
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            if end - 1 > start:
+                digit = classifyDigit(np.flatnonzero(high[i, start:end]),
+                                      np.flatnonzero(low[i, start:end]),
+                                      np.flatnonzero(findRunStarts(masks[i, :, start + (end - start) // 2])))
+                if digit != "" or np.count_nonzero(masks[i, :, start:end]) >= GLYPH_MIN_PIXELS:
+                    glyphs.append((i, digit, calculateGlyphFeatures(masks[i, :, start:end])))
+
+    return glyphs
+
+def calculateGlyphFeatures(glyphMask):
+    rows = np.flatnonzero(glyphMask.any(axis=1))
+    if len(rows) > 0:
+        glyphMask = glyphMask[rows[0]:rows[-1] + 1]
+    return cv2.resize(glyphMask.astype(np.float32), GLYPH_FEATURE_SIZE, interpolation=cv2.INTER_AREA).ravel()
+
+def classifyGlyphs(glyphs, count, atlas = None):
+    numbers = ["" for i in range(count)]
+    # An amount is only as certain as its least certain digit, amounts without any glyph could not be read at all
+    confidences = [None for i in range(count)]
+    if len(glyphs) == 0:
+        return numbers, [0.0 for i in range(count)]
+
+    indices, ruleDigits, features = zip(*glyphs)
+    if atlas is not None and not atlas.isEmpty():
+        atlasDigits, atlasConfidences = atlas.classify(np.stack(features))
+    else:
+        # Without an atlas only the rules can read a glyph, what they could not read stays unreadable
+        atlasDigits, atlasConfidences = ruleDigits, [1.0 if d != "" else 0.0 for d in ruleDigits]
+
+    for i, ruleDigit, atlasDigit, atlasConfidence in zip(indices, ruleDigits, atlasDigits, atlasConfidences):
+        if ruleDigit != "":
+            # The rules stay in charge, the atlas only lowers the confidence when it disagrees
+            digit = ruleDigit
+            confidence = 1.0 if atlasDigit == ruleDigit else 1.0 - atlasConfidence
+        elif atlasConfidence > 0:
+            digit = atlasDigit
+            confidence = atlasConfidence
+        else:
+            # Still skipped like before, but the amount is no longer reported as certain
+            digit = ""
+            confidence = 0.0
+
+        numbers[i] += digit
+        confidences[i] = confidence if confidences[i] is None else min(confidences[i], confidence)
+
+    return numbers, [c if c is not None else 0.0 for c in confidences]
+
+def collectGlyphSamples(glyphs):
+    # Only amounts the rules could read completely are trusted to teach the atlas
+    failedAmounts = set(i for i, digit, features in glyphs if digit == "")
+    return [(features, digit) for i, digit, features in glyphs if i not in failedAmounts]
+
+class GlyphAtlas:
+    def __init__(self, features = None, labels = None):
+        self.features = features if features is not None else np.zeros((0, GLYPH_FEATURE_SIZE[0] * GLYPH_FEATURE_SIZE[1]), dtype=np.float32)
+        self.labels = labels if labels is not None else np.zeros(0, dtype="<U1")
+
+    def isEmpty(self):
+        return len(self.labels) == 0
+
+    def classify(self, features):
+        # Nearest neighbour for all glyphs at once, confidence compares it to the nearest other digit
+        distances = ((features[:, np.newaxis, :] - self.features[np.newaxis, :, :]) ** 2).sum(axis=2)
+        nearest = np.argmin(distances, axis=1)
+        labels = self.labels[nearest]
+        nearestDistance = distances[np.arange(len(features)), nearest]
+
+        otherDistances = np.where(self.labels[np.newaxis, :] == labels[:, np.newaxis], np.inf, distances)
+        otherDistance = otherDistances.min(axis=1)
+        confidences = np.where(np.isinf(otherDistance), 1.0, 1.0 - nearestDistance / np.maximum(otherDistance, 1e-6))
+        confidences[nearestDistance > GLYPH_MAX_DISTANCE] = 0
+
+        return labels.tolist(), np.clip(confidences, 0, 1).tolist()
+
+    def add(self, samples):
+        added = 0
+        for features, digit in samples:
+            if np.count_nonzero(self.labels == digit) < GLYPH_ATLAS_SAMPLES_PER_DIGIT:
+                self.features = np.vstack([self.features, features[np.newaxis]])
+                self.labels = np.append(self.labels, digit)
+                added += 1
+        return added
+
+    def save(self, fileName):
+        np.savez(fileName, features=self.features, labels=self.labels, version=GLYPH_ATLAS_VERSION)
+
+    @staticmethod
+    def load(fileName):
+        if os.path.isfile(fileName):
+            with np.load(fileName) as atlas:
+                if int(atlas["version"]) == GLYPH_ATLAS_VERSION:
+                    return GlyphAtlas(atlas["features"], atlas["labels"])
+        return GlyphAtlas()
+
+class AmountReadings:
+    def __init__(self, amounts, confidences, glyphSamples, masks):
+        self.amounts = amounts
+        self.confidences = confidences
+        self.glyphSamples = glyphSamples
+        self.masks = masks
+
+def readCrops(crops, keepMasks = False, atlas = None, size = None):
+    masks, overlayStarts = prepareArrays(crops, size)
+    glyphs = findGlyphs(masks, overlayStarts)
+    amounts, confidences = classifyGlyphs(glyphs, len(crops), atlas)
+
+    croppedMasks = None
+    if keepMasks:
+        croppedMasks = [m[:, overlayStart:] for m, overlayStart in zip(masks, overlayStarts)]
+    return AmountReadings(amounts, confidences, collectGlyphSamples(glyphs), croppedMasks)
+
+def findRunStarts(lines):
+    previous = np.zeros_like(lines)
+    previous[..., 1:] = lines[..., :-1]
+    return lines & ~previous
+
+if __name__ == "__main__":
+    # Compares the array based OCR against the pixel based reference, e.g. on the crops of a debug scan
+    import os
+    import sys
+    import time
+
+    folder = sys.argv[1] if len(sys.argv) > 1 else "debug/numbers"
+    names = [f for f in sorted(os.listdir(folder)) if f.endswith(".png")]
+    crops = [Image.open(os.path.join(folder, f)).convert("RGB") for f in names]
+
+    start = time.perf_counter()
+    reference = [readImage(prepareImage(c)) for c in crops]
+    referenceTime = time.perf_counter() - start
+
+    start = time.perf_counter()
+    results = [readArray(prepareArray(c)) for c in crops]
+    arrayTime = time.perf_counter() - start
+
+    start = time.perf_counter()
+    batchResults = []
+    # Batches of one screen of boxes
+    for i in range(0, len(crops), 21):
+        batchResults += readArrays(*prepareArrays(crops[i:i + 21]))
+    batchTime = time.perf_counter() - start
 
+    mismatches = [(f, r, a, b) for f, r, a, b in zip(names, reference, results, batchResults) if r != a or r != b]
+    for f, r, a, b in mismatches:
+        print(f"Mismatch in {f}: '{r}' != '{a}' / '{b}'")
 
+    print(f"{len(crops)} crops, {len(mismatches)} mismatches")
+    print(f"Pixel loops: {referenceTime:.3f}s ({referenceTime / max(1, len(crops)) * 1000:.2f}ms per crop)")
+    print(f"Arrays:      {arrayTime:.3f}s ({arrayTime / max(1, len(crops)) * 1000:.2f}ms per crop)")
+    print(f"Batches:     {batchTime:.3f}s ({batchTime / max(1, len(crops)) * 1000:.2f}ms per crop)")
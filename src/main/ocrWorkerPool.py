@@ -0,0 +1,60 @@
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+def runTimed(function, *args):
+    # Module level so it can be sent to worker processes, the duration excludes time spent in the queue
+    start = time.perf_counter()
+    result = function(*args)
+    process = multiprocessing.current_process()
+    worker = threading.current_thread().name if process.name == "MainProcess" else process.name
+    return result, (time.perf_counter() - start, start, worker)
+
+class OcrWorkerPool:
+    def __init__(self, workers, queueSize, useProcesses = False):
+        if useProcesses:
+            self.executor = ProcessPoolExecutor(max_workers=workers)
+        else:
+            self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="OCR")
+
+        # Running and queued work share the slots, so submitting blocks once the queue is full
+        self.slots = threading.Semaphore(workers + queueSize)
+        self.lock = threading.Lock()
+        self.futures = set()
+        self.cancelled = False
+
+    def submit(self, callback, function, *args):
+        self.slots.acquire()
+        with self.lock:
+            if self.cancelled:
+                self.slots.release()
+                return None
+
+            future = self.executor.submit(runTimed, function, *args)
+            self.futures.add(future)
+
+        future.add_done_callback(lambda f: self.finish(f, callback))
+        return future
+
+    def finish(self, future, callback):
+        try:
+            if not future.cancelled():
+                callback(future)
+        finally:
+            with self.lock:
+                self.futures.discard(future)
+            self.slots.release()
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+            futures = list(self.futures)
+
+        # Work that is already running finishes, everything still queued is dropped
+        for f in futures:
+            f.cancel()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
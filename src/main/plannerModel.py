@@ -0,0 +1,79 @@
+from collections import Counter
+
+import numpy as np
+
+from requirementEngine import RequirementEngine
+
+class DepotModel:
+    # Depot contents and everything derived from them, kept in plain Python and arrays so it can be calculated without
+    # a display. Widgets subscribe to it and are told which materials changed after every recalculation
+    __slots__ = ("engine", "contents", "trueRequirements", "requirements", "missing", "craftable", "craftableSet",
+                 "dirtyMaterials", "listeners")
+
+    def __init__(self, materials, initialContents = {}):
+        self.engine = RequirementEngine(materials)
+        size = len(self.engine.materials)
+        self.contents = self.engine.toArray({ m: a for m, a in initialContents.items() if m in self.engine.indices })
+        self.trueRequirements = Counter()
+        self.requirements = np.zeros(size, dtype=np.int64)
+        self.missing = np.zeros(size, dtype=np.int64)
+        self.craftable = []
+        self.craftableSet = set()
+
+        self.dirtyMaterials = set()
+        self.listeners = []
+
+    def subscribe(self, listener):
+        # Listeners are called with the set of materials whose amount, requirement, missing amount or craftability
+        # changed
+        self.listeners.append(listener)
+
+    def getMaterials(self):
+        return self.engine.materials
+
+    def getAmount(self, material):
+        return int(self.contents[self.engine.indices[material]])
+
+    def getRequirement(self, material):
+        return int(self.requirements[self.engine.indices[material]])
+
+    def getMissing(self, material):
+        return int(self.missing[self.engine.indices[material]])
+
+    def isCraftable(self, material):
+        return material in self.craftableSet
+
+    def getContents(self):
+        return dict(zip(self.engine.materials, self.contents.tolist()))
+
+    def setAmount(self, material, amount):
+        # Only marks the material, recalculate has to be called afterwards. Returns whether the amount changed
+        i = self.engine.indices[material]
+        if self.contents[i] == amount:
+            return False
+        self.contents[i] = amount
+        self.dirtyMaterials.add(material)
+        return True
+
+    def setAmounts(self, amounts):
+        for m, a in amounts.items():
+            self.setAmount(m, a)
+
+    def setRequirements(self, requirements):
+        self.trueRequirements = Counter(requirements)
+
+    def recalculate(self):
+        requirements, missing, craftable = self.engine.calculate(self.trueRequirements, self.contents)
+        craftableSet = set(craftable)
+
+        changedIndices = np.nonzero((requirements != self.requirements) | (missing != self.missing))[0]
+        changed = self.dirtyMaterials | craftableSet.symmetric_difference(self.craftableSet)
+        changed.update(self.engine.materials[i] for i in changedIndices.tolist())
+
+        self.requirements, self.missing = requirements, missing
+        self.craftable, self.craftableSet = craftable, craftableSet
+        self.dirtyMaterials = set()
+
+        for listener in self.listeners:
+            listener(changed)
+        return changed
@@ -0,0 +1,200 @@
+import numpy as np
+
+# Amounts tried at once when searching how many of a material can be crafted
+SEARCH_CANDIDATES = 32
+UNLIMITED = np.iinfo(np.int64).max
+
+class RequirementEngine:
+    # Crafting requirements, missing amounts and craftable materials of a depot, computed on arrays indexed like the
+    # materials the engine was built for
+    def __init__(self, materials):
+        self.materials = list(materials)
+        self.indices = { m: i for i, m in enumerate(self.materials) }
+        size = len(self.materials)
+
+        self.tiers = np.array([m.tier for m in self.materials])
+        self.craftableMask = np.array([m.isCraftable() for m in self.materials], dtype=bool)
+        # Only materials of the five tiers are crafted or crafted from
+        self.tierMask = (self.tiers >= 1) & (self.tiers <= 5)
+        self.lmd = next((i for i, m in enumerate(self.materials) if m.canonicalName == "LMD"), None)
+
+        # Recipes compiled once, row i holds how much of each material crafting one of material i takes. NumPy only
+        # multiplies float matrices quickly, and amounts stay far below where floats stop being exact
+        self.recipes = np.zeros((size, size), dtype=np.float64)
+        for i, m in enumerate(self.materials):
+            if m.isCraftable():
+                for ingredient, amount in m.getIngredients().items():
+                    self.recipes[i, self.indices[ingredient]] = amount
+        # Ingredients in the order of their recipes, the order in which crafting adds them to what is missing
+        self.ingredientOrder = [[self.indices[ingredient] for ingredient in m.getIngredients()] if m.isCraftable() else []
+                                for m in self.materials]
+        self.leaves = np.nonzero(~self.craftableMask)[0]
+        self.craftables = np.nonzero(self.craftableMask)[0]
+
+        # Materials are handled before their ingredients. For the game's recipes that is the order of the tiers, a
+        # recipe using a material of the same or a higher tier lifts the crafted material a level above it instead
+        self.levels = self.calculateLevels()
+        self.levelRows = {}
+        self.levelCrafted = {}
+        self.levelRecipes = {}
+        self.levelUses = {}
+        for level in np.unique(self.levels[self.tierMask]).tolist():
+            rows = np.nonzero((self.levels == level) & self.tierMask)[0]
+            self.levelRows[level] = rows
+            self.levelCrafted[level] = rows[self.craftableMask[rows]]
+            self.levelRecipes[level] = self.recipes[self.levelCrafted[level]]
+            self.levelUses[level] = self.levelRecipes[level] > 0
+        self.descendingLevels = sorted(self.levelRows.keys(), reverse=True)
+        self.craftingLevels = [level for level in self.descendingLevels if len(self.levelCrafted[level]) > 0]
+        # Crafting paths are expanded level by level, whatever the tier of the crafted materials. Crafting takes the
+        # ingredients and gives the crafted material, which is what the path was short of
+        expansionLevels = []
+        for level in sorted(set(self.levels[self.craftables].tolist()), reverse=True):
+            rows = self.craftables[self.levels[self.craftables] == level]
+            crafting = self.recipes[rows]
+            crafting[np.arange(len(rows)), rows] -= 1
+            expansionLevels.append((level, rows, crafting))
+        self.expansionsBelow = { level: [e for e in expansionLevels if e[0] < level] for level in self.levelRows }
+        # Craftable materials are listed by tier like the depot shows them
+        self.displayOrder = np.lexsort((np.arange(size), self.tiers))
+
+    def calculateLevels(self):
+        levels = self.tiers.copy()
+        uses = self.recipes > 0
+        for i in range(len(self.materials) + 1):
+            lifted = np.maximum(self.tiers, np.where(uses, levels[None, :] + 1, levels.min()).max(axis=1, initial=levels.min()))
+            if (lifted == levels).all():
+                return levels
+            levels = lifted
+        raise ValueError("Recipes of the materials contain a cycle")
+
+    def toArray(self, amounts):
+        array = np.zeros(len(self.materials), dtype=np.int64)
+        for m, a in amounts.items():
+            array[self.indices[m]] = a
+        return array
+
+    def calculate(self, trueRequirements, contents):
+        # Returns the crafting requirements and missing amounts as arrays, and the craftable materials as a list
+        requested = self.toArray(trueRequirements)
+        requirements = self.expandRequirements(requested.copy(), contents)
+        # Materials of a level compete for the depot in the order they were first needed, starting with the order of
+        # the requirements
+        order = [self.indices[m] for m, a in trueRequirements.items() if a > 0]
+        missing = self.calculateMissing(requested, order, contents)
+        return requirements, missing, self.findCraftable(requirements, missing, contents)
+
+    def expandRequirements(self, requirements, contents):
+        for level in self.craftingLevels:
+            rows = self.levelCrafted[level]
+            excess = np.maximum(0, requirements[rows] - contents[rows])
+            requirements += (excess @ self.levelRecipes[level]).astype(np.int64)
+        return requirements
+
+    def calculateMissing(self, missing, order, contents):
+        # The materials in order are ranked first, ingredients are ranked after them in the order crafting adds them.
+        # Amounts are floats while crafting, like the recipes
+        missing = missing.astype(np.float64)
+        available = contents.astype(np.float64)
+        ranks = np.full(len(self.materials), len(self.materials), dtype=np.int64)
+        ranks[order] = np.arange(len(order))
+        ranked = len(order)
+        for level in self.descendingLevels:
+            rows = self.levelRows[level]
+            # Every material uses up what the depot has of it first, nothing else of the level needs that
+            direct = np.minimum(np.maximum(missing[rows], 0), available[rows])
+            missing[rows] -= direct
+            available[rows] -= direct
+            if self.lmd is not None and self.levels[self.lmd] == level:
+                # LMD is never used up, it is only compared against
+                available[self.lmd] += direct[rows == self.lmd].sum()
+
+            rows = self.levelCrafted[level]
+            crafted = rows[missing[rows] > 0]
+            if len(crafted) > 0:
+                crafted = crafted[np.argsort(ranks[crafted], kind="stable")]
+                self.craftMissing(crafted, level, missing, available)
+                ranked = self.rankIngredients(crafted[missing[crafted] > 0], ranks, ranked)
+                missing += np.maximum(missing[rows], 0) @ self.levelRecipes[level]
+        return np.maximum(missing, 0).astype(np.int64)
+
+    def craftMissing(self, crafted, level, missing, available):
+        # The materials compete for the depot one after another in the order they are given. Everything the depot still
+        # has enough for is crafted at once, up to the first material it falls short for. The depot only gets emptier,
+        # so what a single one takes bounds how many can be crafted from then on
+        amounts = missing[crafted]
+        while len(crafted) > 0:
+            recipes = self.recipes[crafted]
+            paths = self.expandPath(np.concatenate((np.cumsum(amounts[:, None] * recipes, axis=0), recipes)), available,
+                                    level)
+            fitting = np.count_nonzero(~self.isShort(paths[:len(crafted)], available))
+            if fitting == len(crafted):
+                missing[crafted] -= amounts
+                available -= paths[fitting - 1]
+                return
+
+            bounds = self.scaleToLeaves(paths[len(crafted):], 1, available, amounts)
+            if fitting > 0:
+                missing[crafted[:fitting]] -= amounts[:fitting]
+                available -= paths[fitting - 1]
+
+            i = crafted[fitting]
+            if bounds[fitting] > 0:
+                missing[i] -= self.craftAmount(i, level, int(bounds[fitting]), available)
+            crafted, amounts = crafted[fitting + 1:], bounds[fitting + 1:]
+            crafted, amounts = crafted[amounts > 0], amounts[amounts > 0]
+
+    def rankIngredients(self, crafted, ranks, ranked):
+        # Ingredients needed for the first time are ranked after everything needed before them
+        for i in crafted.tolist():
+            for ingredient in self.ingredientOrder[i]:
+                if ranks[ingredient] == len(self.materials):
+                    ranks[ingredient] = ranked
+                    ranked += 1
+        return ranked
+
+    def craftAmount(self, i, level, high, available):
+        # Crafts as many as possible of at most high and returns how many that were. Crafting more never gets possible
+        # by crafting less, so the largest possible amount is searched among evenly spread candidates, all of which are
+        # expanded at once
+        low, lowPath = 0, None
+        while lowPath is None or low < high:
+            step = -((low - high) // (SEARCH_CANDIDATES - 1))
+            candidates = np.append(np.arange(low, high, max(step, 1)), high)
+            paths = self.expandPath(candidates[:, None] * self.recipes[i], available, level)
+            possible = np.count_nonzero(~self.isShort(paths, available))
+            low, lowPath = int(candidates[possible - 1]), paths[possible - 1]
+            high = int(candidates[possible]) - 1 if possible < len(candidates) else low
+
+        available -= lowPath
+        return low
+
+    def scaleToLeaves(self, paths, amounts, available, limits):
+        # How many the leaves have enough for when they scale linearly with the amounts, at most limits. Works on a
+        # single path as well as on one path per row
+        demand = paths[..., self.leaves]
+        leaves = available[self.leaves]
+        scaled = np.where(demand > 0, leaves * amounts // np.maximum(demand, 1), UNLIMITED)
+        return np.minimum(scaled.min(axis=-1), limits)
+
+    def expandPath(self, path, available, level):
+        # Everything there is gets used, the rest is crafted from ingredients until only materials that can not be
+        # crafted are left short. Ingredients are of a lower level than what they craft, so going down the levels
+        # below the crafted materials once is enough. Works on a single path as well as on one path per row
+        for lower, rows, crafting in self.expansionsBelow[level]:
+            need = np.maximum(path[..., rows] - available[rows], 0)
+            if need.any():
+                path = path + need @ crafting
+        return path
+
+    def isShort(self, path, available):
+        return (path[..., self.leaves] > available[self.leaves]).any(axis=-1)
+
+    def findCraftable(self, requirements, missing, contents):
+        craftable = self.tierMask & ~self.craftableMask & (requirements <= contents)
+        for level in reversed(self.craftingLevels):
+            # Every ingredient has to be craftable itself or not be missing
+            blocked = self.levelUses[level] & ~(craftable | (missing <= 0))[None, :]
+            craftable[self.levelCrafted[level]] = ~blocked.any(axis=1)
+
+        return [self.materials[i] for i in self.displayOrder[craftable[self.displayOrder]].tolist()]
@@ -0,0 +1,154 @@
+import queue
+import threading
+import time
+
+# Marks the end of the items a stage passes on
+STOP = object()
+
+QUEUE_POLL_INTERVAL = 0.1
+
+class PipelineStage:
+    def __init__(self, pipeline, name, work, inputQueue, outputQueue, finish = None, stallCallback = None):
+        self.pipeline = pipeline
+        self.name = name
+        self.work = work
+        self.inputQueue = inputQueue
+        self.outputQueue = outputQueue
+        self.finish = finish
+        self.stallCallback = stallCallback
+
+        self.items = 0
+        self.busyTime = 0
+        self.stallTime = 0
+        self.maxQueueDepth = 0
+        self.startTime = None
+        self.endTime = None
+
+    def run(self):
+        self.startTime = time.perf_counter()
+        try:
+            if self.inputQueue is None:
+                # Sources produce items on their own until they are done
+                self.work(self.emit)
+            else:
+                while True:
+                    item = self.take()
+                    if item is STOP:
+                        break
+
+                    start = time.perf_counter()
+                    self.work(item, self.emit)
+                    self.busyTime += time.perf_counter() - start
+                    self.items += 1
+
+            if self.finish is not None:
+                self.finish(self.emit)
+        except Exception as e:
+            self.pipeline.fail(e)
+        finally:
+            self.endTime = time.perf_counter()
+            if self.inputQueue is None:
+                self.busyTime = self.endTime - self.startTime - self.stallTime
+            if self.outputQueue is not None:
+                self.put(STOP, force=True)
+
+    def take(self):
+        start = time.perf_counter()
+        stalled = self.inputQueue.empty()
+        if stalled and self.stallCallback is not None:
+            self.stallCallback(True)
+
+        try:
+            while True:
+                try:
+                    return self.inputQueue.get(timeout=QUEUE_POLL_INTERVAL)
+                except queue.Empty:
+                    if self.pipeline.interrupted:
+                        return STOP
+        finally:
+            self.stallTime += time.perf_counter() - start
+            if stalled and self.stallCallback is not None:
+                self.stallCallback(False)
+
+    def emit(self, item):
+        if self.inputQueue is None:
+            self.items += 1
+        self.put(item)
+
+    def put(self, item, force = False):
+        start = time.perf_counter()
+        while not self.pipeline.interrupted or force:
+            try:
+                self.outputQueue.put(item, timeout=QUEUE_POLL_INTERVAL)
+                self.maxQueueDepth = max(self.maxQueueDepth, self.outputQueue.qsize())
+                break
+            except queue.Full:
+                if force and self.pipeline.interrupted:
+                    # Make room for the stop marker, nobody is going to process the rest anyway
+                    self.drain()
+        self.stallTime += time.perf_counter() - start
+
+    def drain(self):
+        try:
+            while True:
+                self.outputQueue.get_nowait()
+        except queue.Empty:
+            pass
+
+    def getQueueDepth(self):
+        if self.inputQueue is None:
+            return 0
+        return self.inputQueue.qsize()
+
+    def getItemsPerSecond(self):
+        if self.startTime is None:
+            return 0
+        duration = (self.endTime or time.perf_counter()) - self.startTime
+        return self.items / duration if duration > 0 else 0
+
+class ScanPipeline:
+    def __init__(self, queueSize, errorCallback = None):
+        self.queueSize = queueSize
+        self.errorCallback = errorCallback
+        self.stages = []
+        self.interrupted = False
+
+    def addSource(self, name, work):
+        self.stages.append(PipelineStage(self, name, work, None, None))
+
+    def addStage(self, name, work, finish = None, stallCallback = None):
+        connection = queue.Queue(maxsize=self.queueSize)
+        self.stages[-1].outputQueue = connection
+        self.stages.append(PipelineStage(self, name, work, connection, None, finish=finish, stallCallback=stallCallback))
+
+    def run(self):
+        threads = [threading.Thread(target=s.run, name="Scan-" + s.name) for s in self.stages]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+    def stop(self):
+        self.interrupted = True
+
+    def fail(self, error):
+        self.stop()
+        if self.errorCallback is not None:
+            self.errorCallback(error)
+
+    def getMetrics(self):
+        return [{ "stage": s.name,
+                  "items": s.items,
+                  "itemsPerSecond": s.getItemsPerSecond(),
+                  "busyTime": s.busyTime,
+                  "stallTime": s.stallTime,
+                  "queueDepth": s.getQueueDepth(),
+                  "maxQueueDepth": s.maxQueueDepth } for s in self.stages]
+
+    def report(self):
+        # Queue depth is the maximum number of items that waited for the next stage
+        lines = ["{:<10} {:>6} {:>8} {:>8} {:>9} {:>6}".format("Stage", "Items", "Items/s", "Busy(s)", "Stall(s)", "Queue")]
+        for m in self.getMetrics():
+            lines.append("{:<10} {:>6} {:>8.2f} {:>8.3f} {:>9.3f} {:>6}".format(
+                m["stage"], m["items"], m["itemsPerSecond"], m["busyTime"], m["stallTime"], m["maxQueueDepth"]))
+        return "\n".join(lines)
@@ -0,0 +1,73 @@
+import json
+import os
+import sys
+import threading
+import time
+
+from utilImport import *
+from gameDataReader import downloadMaterialData
+from database import loadMaterials
+from templateBank import loadTemplateBank
+from DepotParser import DepotParser
+
+SCREENSHOT_EXTENSIONS = (".png", ".bmp", ".jpg", ".jpeg")
+
+def listScreenshots(folder):
+    return [os.path.join(folder, f) for f in sorted(os.listdir(folder)) if f.lower().endswith(SCREENSHOT_EXTENSIONS)]
+
+def replayScan(screenshotFolder):
+    results = {}
+    finished = threading.Event()
+    success = []
+
+    def notifyStatus(text, error = False):
+        if error:
+            LOGGER.error("Replay: %s", text)
+
+    def notifyMaterial(material, amount, confidence = 1):
+        results[material] = amount
+
+    def notifyFinish(finishedScan):
+        success.append(finishedScan)
+        finished.set()
+
+    parser = DepotParser(images=listScreenshots(screenshotFolder), confidenceThreshold=CONFIG.imageRecognitionThreshold)
+
+    start = time.perf_counter()
+    parser.startParsing(notifyStatus, notifyMaterial, notifyFinish)
+    finished.wait()
+    parser.destroy()
+    totalTime = time.perf_counter() - start
+
+    print(parser.timer.report(totalTime))
+    if parser.pipeline is not None:
+        print(parser.pipeline.report())
+    return results, success[0]
+
+def compareWithGroundTruth(results, groundTruth):
+    correct = 0
+    print("{:<30} {:>10} {:>10}".format("Material", "Expected", "Scanned"))
+    for name, expected in groundTruth.items():
+        material = MATERIALS[name]
+        scanned = results.get(material, "-")
+        if scanned == expected:
+            correct += 1
+        else:
+            print("{:<30} {:>10} {:>10}".format(material.canonicalName, expected, str(scanned)))
+
+    print(f"{correct} of {len(groundTruth)} materials correct ({correct / max(1, len(groundTruth)):.1%})")
+    return correct == len(groundTruth)
+
+if __name__ == "__main__":
+    # Usage: scanReplay.py <folder with page screenshots in scan order> [ground truth json: { "<material name>": amount }]
+    downloadMaterialData()
+    loadMaterials(lambda current, goal: None)
+    loadTemplateBank()
+
+    results, finishedScan = replayScan(sys.argv[1])
+    if not finishedScan:
+        LOGGER.warning("Replay ended before the end of the depot was reached")
+
+    if len(sys.argv) > 2:
+        passed = compareWithGroundTruth(results, json.load(open(sys.argv[2], "r")))
+        sys.exit(0 if passed else 1)
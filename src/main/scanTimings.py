@@ -0,0 +1,69 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from threading import Lock
+
+class StageTimer:
+    def __init__(self, tracing = False):
+        self.lock = Lock()
+        self.times = {}
+        self.counts = {}
+        self.maxima = {}
+        # Trace events are only kept when asked for, a scan produces a few thousand of them
+        self.tracing = tracing
+        self.events = []
+        self.threadNames = {}
+
+    @contextmanager
+    def measure(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start, start)
+
+    def add(self, stage, duration, start = None, threadName = None):
+        with self.lock:
+            self.times[stage] = self.times.get(stage, 0) + duration
+            self.counts[stage] = self.counts.get(stage, 0) + 1
+            self.maxima[stage] = max(self.maxima.get(stage, 0), duration)
+
+            if self.tracing:
+                if start is None:
+                    start = time.perf_counter() - duration
+                if threadName is None:
+                    threadName = threading.current_thread().name
+                self.events.append((stage, start, duration, threadName))
+
+    def report(self, totalTime = None):
+        # Stages can run in parallel threads, so their times do not necessarily add up to the total
+        lines = ["{:<16} {:>6} {:>10} {:>10} {:>10}".format("Stage", "Calls", "Total(s)", "Avg(ms)", "Max(ms)")]
+        with self.lock:
+            for stage, duration in self.times.items():
+                lines.append("{:<16} {:>6} {:>10.3f} {:>10.2f} {:>10.2f}".format(stage, self.counts[stage], duration,
+                                                                                duration / self.counts[stage] * 1000,
+                                                                                self.maxima[stage] * 1000))
+        if totalTime is not None:
+            lines.append("{:<16} {:>6} {:>10.3f}".format("wall", "", totalTime))
+
+        return "\n".join(lines)
+
+    def writeTrace(self, fileName):
+        # Chrome trace event format, can be opened in chrome://tracing or https://ui.perfetto.dev
+        with self.lock:
+            events = list(self.events)
+        origin = min((e[1] for e in events), default=0)
+        threadIds = {}
+        traceEvents = []
+        for stage, start, duration, threadName in events:
+            threadId = threadIds.setdefault(threadName, len(threadIds) + 1)
+            traceEvents.append({ "name": stage, "cat": "scan", "ph": "X", "pid": os.getpid(), "tid": threadId,
+                                 "ts": (start - origin) * 1e6, "dur": duration * 1e6 })
+        for threadName, threadId in threadIds.items():
+            traceEvents.append({ "name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": threadId,
+                                 "args": { "name": threadName } })
+
+        with open(fileName, "w") as f:
+            json.dump({ "traceEvents": traceEvents, "displayTimeUnit": "ms" }, f)
@@ -0,0 +1,113 @@
+import hashlib
+import os.path
+
+import cv2
+import numpy as np
+
+from utilImport import *
+from downloadUtil import DYNAMIC_DATA_PATH
+from imageRecognizing import createMask, downsampleGray, downsample
+
+TEMPLATE_BANK_FILE = DYNAMIC_DATA_PATH + "templateBank.npz"
+# Bump this whenever the way templates or masks are built changes, so stored banks get rebuilt
+TEMPLATE_BANK_VERSION = 1
+
+TEMPLATES = {}
+# Templates resized to the resolution of the screenshots, keyed by material and scale
+SCALED_TEMPLATES = {}
+
+class MaterialTemplate:
+    def __init__(self, image, mask):
+        self.image = image
+        self.mask = mask
+        self.coarse = None
+
+    def getCoarse(self):
+        # Grayscale level of the coarse to fine matching, built on first use as most scans only need a few templates
+        if self.coarse is None:
+            image = downsampleGray(self.image)
+            self.coarse = MaterialTemplate(image, downsample(self.mask))
+        return self.coarse
+
+def buildTemplate(material):
+    templateImage = material.renderImage().convert("RGB")
+    mask = createMask(material, templateImage.size)
+
+    return MaterialTemplate(np.array(templateImage), mask)
+
+def getTemplate(material, scale = 1):
+    if material not in TEMPLATES:
+        TEMPLATES[material] = buildTemplate(material)
+    if scale == 1:
+        return TEMPLATES[material]
+
+    if (material, scale) not in SCALED_TEMPLATES:
+        SCALED_TEMPLATES[(material, scale)] = scaleTemplate(TEMPLATES[material], scale)
+    return SCALED_TEMPLATES[(material, scale)]
+
+def scaleTemplate(template, scale):
+    height, width = template.image.shape[:2]
+    size = (int(round(width * scale)), int(round(height * scale)))
+    interpolation = cv2.INTER_AREA if scale < 1 else cv2.INTER_CUBIC
+
+    return MaterialTemplate(cv2.resize(template.image, size, interpolation=interpolation),
+                            cv2.resize(template.mask, size, interpolation=cv2.INTER_LINEAR))
+
+def calculateSourceHash(materials):
+    # Built from what templates are rendered from, so loading a stored bank does not render any material
+    sourceHash = hashlib.sha1(str(TEMPLATE_BANK_VERSION).encode())
+    borders = {}
+    for m in materials:
+        if m.tier not in borders:
+            with open(getBorderPath(m.tier), "rb") as f:
+                borders[m.tier] = hashlib.sha1(f.read()).digest()
+        sourceHash.update(m.name.encode())
+        sourceHash.update(borders[m.tier])
+        sourceHash.update(str(m.image.size).encode())
+        sourceHash.update(m.image.tobytes())
+
+    return sourceHash.hexdigest()
+
+def loadTemplateBank(progressCallback = None):
+    materials = sorted(MATERIALS.values(), key=lambda m: m.name)
+    sourceHash = calculateSourceHash(materials)
+
+    TEMPLATES.clear()
+    SCALED_TEMPLATES.clear()
+    if readTemplateBank(sourceHash, materials):
+        LOGGER.debug("Loaded material templates from %s", TEMPLATE_BANK_FILE)
+        return
+
+    for i, m in enumerate(materials):
+        if progressCallback is not None:
+            progressCallback(i, len(materials))
+        TEMPLATES[m] = buildTemplate(m)
+
+    writeTemplateBank(sourceHash)
+
+def readTemplateBank(sourceHash, materials):
+    if not os.path.isfile(TEMPLATE_BANK_FILE):
+        return False
+
+    try:
+        with np.load(TEMPLATE_BANK_FILE) as bank:
+            if str(bank["sourceHash"]) != sourceHash:
+                return False
+
+            for m in materials:
+                TEMPLATES[m] = MaterialTemplate(bank[m.name + ".image"], bank[m.name + ".mask"])
+    except Exception as e:
+        LOGGER.warning("Could not read template bank, rebuilding it: %s", e)
+        TEMPLATES.clear()
+        return False
+
+    return True
+
+def writeTemplateBank(sourceHash):
+    arrays = {}
+    for m, t in TEMPLATES.items():
+        arrays[m.name + ".image"] = t.image
+        arrays[m.name + ".mask"] = t.mask
+
+    createDirsIfNeeded(TEMPLATE_BANK_FILE)
+    np.savez(TEMPLATE_BANK_FILE, sourceHash=np.array(sourceHash), **arrays)
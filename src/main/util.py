@@ -2,7 +2,6 @@ import json
 import logging
 import os.path
 import sys
-from collections import Counter
 
 from PIL import Image
 
@@ -40,10 +39,25 @@ class Config:
                  arknightsWindowBorder = None,
                  depotScanScrollDelay = 5,
                  depotScanScrollOffset = 25,
+                 depotScanSettleTimeout = 1.5,
+                 depotScanSettleFrames = 2,
+                 depotScanOcrWorkers = 2,
+                 depotScanOcrQueueSize = 2,
+                 depotScanOcrProcesses = False,
+                 depotScanIndexCandidates = 5,
+                 amountCacheSize = 5000,
+                 depotScanTraceFile = None,
                  displayScale = 1,
                  colorLeniency = 3,
                  imageRecognitionThreshold = 0.8,
+                 imageRecognitionSearchRadius = 8,
+                 imageRecognitionFallbackMargin = 0.1,
+                 imageRecognitionCoarseMargin = 0.15,
+                 amountRecognitionConfidenceThreshold = 0.5,
                  debug = True,
+                 debugSampleRate = 1,
+                 debugImageFormat = "png",
+                 debugQueueSize = 256,
                  **kwargs):
 
         self.uiScale = uiScale
@@ -78,10 +92,25 @@ class Config:
         self.arknightsWindowBorder = arknightsWindowBorder
         self.depotScanScrollOffset = depotScanScrollOffset
         self.depotScanScrollDelay = depotScanScrollDelay
+        self.depotScanSettleTimeout = depotScanSettleTimeout
+        self.depotScanSettleFrames = depotScanSettleFrames
+        self.depotScanOcrWorkers = depotScanOcrWorkers
+        self.depotScanOcrQueueSize = depotScanOcrQueueSize
+        self.depotScanOcrProcesses = depotScanOcrProcesses
+        self.depotScanIndexCandidates = depotScanIndexCandidates
+        self.amountCacheSize = amountCacheSize
+        self.depotScanTraceFile = depotScanTraceFile
         self.displayScale = displayScale
         self.colorLeniency = colorLeniency
         self.imageRecognitionThreshold = imageRecognitionThreshold
+        self.imageRecognitionSearchRadius = imageRecognitionSearchRadius
+        self.imageRecognitionFallbackMargin = imageRecognitionFallbackMargin
+        self.imageRecognitionCoarseMargin = imageRecognitionCoarseMargin
+        self.amountRecognitionConfidenceThreshold = amountRecognitionConfidenceThreshold
         self.debug = debug
+        self.debugSampleRate = debugSampleRate
+        self.debugImageFormat = debugImageFormat
+        self.debugQueueSize = debugQueueSize
 
         if self.usesBlueStacks():
             if self.arknightsWindowName is None:
@@ -128,6 +157,9 @@ def loadImage(path, tolerateMissing=False):
         path = "img/ui/naSquare.png"
     return Image.open(path).convert("RGBA")
 
+def getBorderPath(tier):
+    return "img/border/T" + str(tier) + ".png"
+
 def colorize(image, color):
     floatColor = [c / 255 for c in color]
     r, g, b, a = image.split()
@@ -153,57 +185,16 @@ def unpackVar(d):
     return { k: v.get() for k, v in d.items() }
 
 def getMaterialByInternalId(internalId):
-    for m in MATERIALS.values():
-        if m.internalId == internalId:
-            return m
-    LOGGER.warning("Unrecognized Material: %s", internalId)
+    material = ENTITIES.getMaterialByInternalId(internalId)
+    if material is None:
+        LOGGER.warning("Unrecognized Material: %s", internalId)
+    return material
 
 def multiplyCounter(counter, factor):
     for k in counter.keys():
         counter[k] *= factor
     return counter
 
-def craftPossible(missing, available):
-    for tier in range(5, 0, -1):
-        for m in list(missing.keys()):
-            if m.tier != tier:
-                continue
-            if m.canonicalName == "LMD":
-                missing[m] -= min(missing[m], available[m])
-                continue
-
-            while missing[m] > 0:
-                path = findCraftingPath(m, available)
-                if path is None:
-                    break
-                else:
-                    missing[m] -= 1
-                    available -= path
-
-            if m.isCraftable():
-                missing += Counter(multiplyCounter(m.getIngredients(), missing[m]))
-
-def findCraftingPath(material, available):
-    if available[material] > 0:
-        return Counter({ material: 1 })
-    if not material.isCraftable():
-        return None
-
-    path = Counter(material.getIngredients())
-    while True:
-        if path <= available:
-            return path
-        else:
-            for m in list(path.keys()):
-                if available[m] >= path[m]:
-                    continue
-                if not m.isCraftable():
-                    return None
-
-                need = max(0, path[m] - available[m])
-                path += multiplyCounter(Counter(m.getIngredients()), need)
-                path[m] -= need
-
 def save(upgradeSets, depotContents):
     data = {}
     sets = []
@@ -281,10 +272,93 @@ def exceptHook(type, value, traceback):
 
 sys.excepthook = exceptHook
 
-MATERIALS = {}
+class RegistryDict(dict):
+    # Tells the registry about every change, so its indexes are never out of date
+    def __init__(self, changeCallback):
+        super().__init__()
+        self.changeCallback = changeCallback
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.changeCallback()
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self.changeCallback()
+
+    def update(self, *args, **kwargs):
+        super().update(*args, **kwargs)
+        self.changeCallback()
+
+    def setdefault(self, key, default = None):
+        value = super().setdefault(key, default)
+        self.changeCallback()
+        return value
+
+    def pop(self, *args):
+        value = super().pop(*args)
+        self.changeCallback()
+        return value
+
+    def popitem(self):
+        item = super().popitem()
+        self.changeCallback()
+        return item
+
+    def clear(self):
+        super().clear()
+        self.changeCallback()
+
+class EntityRegistry:
+    # Owns the entity dicts by name and keeps indexes over the materials for everything else they are looked up by
+    def __init__(self):
+        self.materials = RegistryDict(self.markStale)
+        self.upgrades = {}
+        self.operators = {}
+
+        self.materialsByInternalId = {}
+        self.depotOrder = []
+        self.depotMaterials = []
+        self.depotPositions = {}
+        self.stale = True
+
+    def markStale(self):
+        self.stale = True
+
+    def buildIndexes(self, depotOrder = ()):
+        # Cleared first, so materials added while the indexes are built mark them stale again
+        self.stale = False
+        materials = list(self.materials.values())
+        self.materialsByInternalId = { m.internalId: m for m in materials }
+        self.depotOrder = list(depotOrder)
+        self.depotMaterials = [self.materials[name] for name in self.depotOrder if name in self.materials]
+        self.depotPositions = { m: i for i, m in enumerate(self.depotMaterials) }
+
+    def ensureIndexes(self):
+        # Materials added or replaced after the last build, e.g. while they are still being loaded, are picked up on
+        # the next lookup
+        if self.stale:
+            self.buildIndexes(self.depotOrder)
+
+    def getMaterialByInternalId(self, internalId):
+        self.ensureIndexes()
+        return self.materialsByInternalId.get(internalId)
+
+    def getDepotOrder(self):
+        # Materials in the order the depot shows them
+        self.ensureIndexes()
+        return self.depotMaterials
+
+    def getDepotPosition(self, material, default = None):
+        self.ensureIndexes()
+        return self.depotPositions.get(material, default)
+
+ENTITIES = EntityRegistry()
+# Views onto the registry, so entities are still looked up by name the way they always were
+MATERIALS = ENTITIES.materials
 UI_ELEMENTS = {}
-UPGRADES = {}
-OPERATORS = {}
+UPGRADES = ENTITIES.upgrades
+OPERATORS = ENTITIES.operators
 
 if not os.path.isfile("config.json"):
     json.dump({}, open("config.json", "w+"))
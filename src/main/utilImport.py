@@ -1,4 +1,4 @@
-from util import LOGGER, CONFIG, MATERIALS, UI_ELEMENTS, UPGRADES, OPERATORS, \
-    loadImage, colorize, safeOpen, safeSave, createDirsIfNeeded, \
+from util import LOGGER, CONFIG, ENTITIES, MATERIALS, UI_ELEMENTS, UPGRADES, OPERATORS, \
+    loadImage, getBorderPath, colorize, safeOpen, safeSave, createDirsIfNeeded, \
     toUpgrades, toMaterials, toOperators, toExternal, unpackVar, getMaterialByInternalId, multiplyCounter, \
-    craftPossible, save, load
\ No newline at end of file
+    save, load
\ No newline at end of file
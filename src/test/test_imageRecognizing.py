@@ -0,0 +1,37 @@
+import os
+import sys
+
+import numpy as np
+from PIL import Image
+
+MAIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "main")
+sys.path.insert(0, MAIN)
+
+from imageRecognizing import matchCoarseToFine, downsample, downsampleGray, COARSE_FACTOR, MATCH_LEVEL_FINE
+
+class ExactTemplate:
+    # Stands in for templateBank.MaterialTemplate, importing that would load the config and write files into the cwd
+    def __init__(self, image, mask):
+        self.image = image
+        self.mask = mask
+
+    def getCoarse(self):
+        return ExactTemplate(downsampleGray(self.image), downsample(self.mask))
+
+def buildExactTemplate():
+    # An icon on its border, matched against an exact copy of itself
+    border = Image.open(os.path.join(MAIN, "img/border/T4.png")).convert("RGBA")
+    icon = Image.open(os.path.join(MAIN, "img/misc/S3.png")).convert("RGBA")
+    border.alpha_composite(icon, ((border.width - icon.width) // 2, (border.height - icon.height) // 2))
+    return ExactTemplate(np.array(border.convert("RGB")), np.array(border.getchannel("A"), dtype=np.float32))
+
+def test_exact_copy_matches_at_every_phase():
+    template = buildExactTemplate()
+    height, width = template.image.shape[:2]
+    for offset in range(22, 22 + COARSE_FACTOR * 2):
+        box = np.zeros((height + 50, width + 50, 3), dtype=np.uint8)
+        box[offset:offset + height, offset:offset + width] = template.image
+        location, confidence, level = matchCoarseToFine(box, template, 0.9, 0.15, searchRadius=10)
+        assert confidence > 0.9, "offset {} scored {:.3f} on the {} level".format(offset, confidence, level)
+        if level != MATCH_LEVEL_FINE:
+            assert location == (offset, offset)